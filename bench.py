@@ -0,0 +1,684 @@
+#!/usr/bin/python
+
+# development-time benchmarks, not needed for normal use. usage:
+#
+#  bench.py [benchmark name...]
+#
+# with no arguments, all benchmarks are run.
+
+import cwall
+import journal
+import util
+
+import os, sys, random, resource, tempfile, cStringIO
+
+import lxml.etree as etree
+from PyQt4 import QtGui, QtCore
+
+# create and return a ClimbingWall with wallCount wall segments and
+# routeCount routes randomly spread over them, all of them active. also
+# sets it as the global cwall.CW. the filter widgets must have been created
+# with createFilters.
+def createWall(routeCount, wallCount = 300):
+    rnd = random.Random(42)
+
+    cw = cwall.ClimbingWall()
+    cwall.CW = cw
+
+    walls = cwall.Walls()
+
+    # zig-zag around so it looks at least a bit like a real gym
+    for i in xrange(wallCount + 1):
+        walls.points.append(cwall.Point(
+                (i % 50) * 150.0 + rnd.uniform(-40.0, 40.0),
+                (i // 50) * 600.0 + (i % 2) * 150.0))
+
+    for i in xrange(1, len(walls.points)):
+        walls.walls.append(cwall.Wall(walls.points[i - 1], walls.points[i]))
+
+    walls.rebuildIndex()
+    cw.walls = walls
+
+    for i in xrange(routeCount):
+        route = cwall.Route()
+        route.attachTo(rnd.choice(walls.walls), rnd.random())
+        cw.addRoute(route)
+
+    cw.updateRouteFilter()
+
+    return cw
+
+# cost of the closest-item queries done on every mouse move
+def benchClosest():
+    moves = 1000
+
+    for routeCount in (100, 1000, 10000):
+        cw = createWall(routeCount)
+
+        rnd = random.Random(1)
+        maxX = max(pt.x for pt in cw.walls.points)
+        maxY = max(pt.y for pt in cw.walls.points)
+
+        positions = [cwall.Point(rnd.uniform(0, maxX), rnd.uniform(0, maxY))
+                     for i in xrange(moves)]
+
+        t = util.TimerDev("%d moves, %d routes" % (moves, routeCount))
+
+        for pos in positions:
+            cwall.M.mousePos = pos
+
+            cwall.getClosestPoint()
+            cwall.getClosestEndPoint()
+            cwall.getClosestRoute()
+
+        del t
+
+# cost of dragging a wall end point around
+def benchDrag():
+    moves = 1000
+
+    for routeCount in (50, 5000):
+        cw = createWall(routeCount)
+
+        mode = cwall.WallMoveMode()
+        mode.closestPt = cw.walls.points[len(cw.walls.points) // 2]
+        cwall.M.mouseDown = True
+
+        pos = cwall.Point(mode.closestPt.x, mode.closestPt.y)
+
+        t = util.TimerDev("%d drag moves, %d routes" % (moves, routeCount))
+
+        for i in xrange(moves):
+            cwall.M.mousePos = cwall.Point(pos.x + i % 10, pos.y)
+            mode.moveEvent()
+
+        del t
+
+        cwall.M.mouseDown = False
+
+# cost of painting all routes
+def benchPaint():
+    paints = 10
+
+    for routeCount in (1000, 10000):
+        cw = createWall(routeCount)
+
+        img = QtGui.QImage(1600, 1200, QtGui.QImage.Format_ARGB32_Premultiplied)
+
+        t = util.TimerDev("%d paints, %d routes" % (paints, routeCount))
+
+        for i in xrange(paints):
+            pnt = QtGui.QPainter()
+            pnt.begin(img)
+            pnt.scale(0.2, 0.2)
+            cw.paintRoutes(pnt)
+            pnt.end()
+
+        del t
+
+# return peak memory use of this process so far, in megabytes
+def peakMemory():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+# cost of loading a large ClimbingWall file
+def benchLoad():
+    routeCount = 10000
+
+    data = etree.tostring(createWall(routeCount).toXml(),
+                          xml_declaration = True, encoding = "UTF-8",
+                          pretty_print = True)
+
+    cwall.CW = cwall.ClimbingWall()
+
+    mem = peakMemory()
+
+    t = util.TimerDev("loading %d routes (%d bytes)" % (
+            routeCount, len(data)))
+
+    cw = cwall.ClimbingWall.load(cStringIO.StringIO(data))
+    cw.updateRouteFilter()
+
+    del t
+
+    print "peak memory: %.1f MB before, %.1f MB after" % (mem, peakMemory())
+
+# cost of loading a climbing profile with lots of ascents
+def benchProfile():
+    ascents = 30000
+
+    rnd = random.Random(13)
+    cp = cwall.ClimbingProfile()
+
+    for i in xrange(10):
+        cwProf = cwall.ClimbingWallProfile(util.UUID())
+        cp.cwProfiles[cwProf.wallId] = cwProf
+
+        for j in xrange(ascents // 10):
+            rp = cwProf.getRouteProfile(util.UUID(), True)
+            rp.toproped = randomDate(rnd)
+            rp.leadClimbed = randomDate(rnd)
+
+    data = etree.tostring(cp.toXml(), xml_declaration = True,
+                          encoding = "UTF-8", pretty_print = True)
+
+    t = util.TimerDev("loading profile with %d ascents (%d bytes)" % (
+            ascents, len(data)))
+
+    loaded = cwall.ClimbingProfile.load(data)
+
+    del t
+
+    t = util.TimerDev("loading one wall's profile")
+    loaded.getWallProfile(cwProf.wallId)
+    del t
+
+    t = util.TimerDev("loading the rest of the walls' profiles")
+    loaded.getWallProfiles()
+    del t
+
+# return given ClimbingWall or ClimbingProfile in XML format
+def toXml(obj):
+    return etree.tostring(obj.toXml(), xml_declaration = True,
+                          encoding = "UTF-8", pretty_print = True)
+
+# size and save/load speed of the binary formats compared to XML. also
+# checks that converting to binary and back loses nothing.
+def benchBinary():
+    routeCount = 10000
+    ascents = 30000
+
+    rnd = random.Random(17)
+    cw = createWall(routeCount)
+
+    for route in cw.routes:
+        route.rating = rnd.choice(cwall.Rating.RATINGS)
+        route.color = rnd.choice(cwall.COLORS)
+        route.marker = rnd.choice(cwall.Marker.MARKERS)
+        route.dateAdded = randomDate(rnd)
+
+    cp = cwall.ClimbingProfile()
+
+    # same routes on 10 different walls
+    for i in xrange(10):
+        wallId = util.UUID()
+
+        for route in rnd.sample(cw.routes, ascents // 10):
+            rp = cp.getRouteProfile(wallId, route.id, True)
+            rp.leadClimbed = randomDate(rnd)
+
+    for name, obj, loadXml in (
+        ("wall with %d routes" % routeCount, cw,
+         lambda data: cwall.ClimbingWall.load(cStringIO.StringIO(data))),
+        ("profile with %d ascents" % ascents, cp,
+         cwall.ClimbingProfile.load)):
+
+        t = util.TimerDev("%s, saving XML" % name)
+        xmlData = toXml(obj)
+        del t
+
+        t = util.TimerDev("%s, saving binary" % name)
+        binData = obj.toBinary()
+        del t
+
+        t = util.TimerDev("%s, loading XML (%d bytes)" % (name, len(xmlData)))
+        fromXml = loadXml(xmlData)
+        del t
+
+        t = util.TimerDev("%s, loading binary (%d bytes)" % (
+                name, len(binData)))
+        fromBin = obj.__class__.loadBinary(binData)
+        del t
+
+        if toXml(fromBin) != toXml(fromXml):
+            print "ERROR: binary round-trip of %s differs" % name
+
+# cost of opening a large wall until its first paint, from XML and from a
+# memory-mapped snapshot
+def benchSnapshot():
+    routeCount = 50000
+
+    rnd = random.Random(19)
+    cw = createWall(routeCount)
+
+    for route in cw.routes:
+        route.rating = rnd.choice(cwall.Rating.RATINGS)
+        route.dateAdded = randomDate(rnd)
+
+    xmlData = toXml(cw)
+
+    fd, filename = tempfile.mkstemp()
+    os.close(fd)
+
+    try:
+        cw.writeSnapshot(filename)
+
+        # only part of the wall is visible at normal zoom levels
+        rect = QtCore.QRectF(0.0, 0.0, 1500.0, 1000.0)
+
+        image = QtGui.QImage(800, 600, QtGui.QImage.Format_RGB32)
+
+        for name, load in (
+            ("XML", lambda: cwall.ClimbingWall.load(
+                    cStringIO.StringIO(xmlData))),
+            ("snapshot", lambda: cwall.ClimbingWall.openSnapshot(filename))):
+
+            t = util.TimerDev("%d routes, opening %s and painting" % (
+                    routeCount, name))
+
+            cw = load()
+            cwall.CW = cw
+            cw.updateRouteFilter()
+
+            pnt = QtGui.QPainter(image)
+            cw.paintRoutes(pnt, rect)
+            pnt.end()
+
+            del t
+
+            print "  %d of %d routes created" % (
+                len([r for r in cw.routes if r]), routeCount)
+
+    finally:
+        os.remove(filename)
+
+# cost of saving a large wall after editing a few routes: a full save,
+# and appending the edits to the journal
+def benchJournal():
+    routeCount = 50000
+    edits = 10
+
+    rnd = random.Random(23)
+    cw = createWall(routeCount)
+
+    dirname = tempfile.mkdtemp()
+
+    try:
+        t = util.TimerDev("%d routes, full save" % routeCount)
+
+        for fname, func in cw.getSaveWork():
+            util.writeFileAtomic(os.path.join(dirname, fname), func())
+
+        del t
+
+        for route in rnd.sample(cw.routes, edits):
+            route.attachTo(rnd.choice(cw.walls.walls), rnd.random())
+
+        jrnl = journal.Journal(os.path.join(dirname, "cw.journal"))
+
+        t = util.TimerDev("%d routes, journaling %d edits" % (
+                routeCount, edits))
+        jrnl.append(cw.getJournalEntries())
+        cw.journalWritten()
+        del t
+
+    finally:
+        for fname in os.listdir(dirname):
+            os.remove(os.path.join(dirname, fname))
+
+        os.rmdir(dirname)
+
+# cost of cataloging a directory of wall files, with and without
+# up-to-date snapshots, and of opening walls through the catalog's cache
+def benchWorkspace():
+    wallCount = 20
+    routeCount = 5000
+
+    dirname = tempfile.mkdtemp()
+
+    try:
+        ids = []
+
+        for i in xrange(wallCount):
+            cw = createWall(routeCount)
+            ids.append(cw.id)
+
+            filename = os.path.join(dirname, "wall%d.xml" % i)
+            util.writeFileAtomic(filename, toXml(cw))
+
+        for withSnapshots in (False, True):
+            if withSnapshots:
+                for i, wallId in enumerate(ids):
+                    filename = os.path.join(dirname, "wall%d.xml" % i)
+
+                    cw = cwall.ClimbingWall.load(filename)
+                    cw.writeSnapshot(cwall.getSidecarFilename(
+                            filename, cwall.SNAPSHOT_EXT))
+
+            ws = cwall.Workspace(len(ids) * routeCount *
+                                 cwall.ROUTE_MEMORY // 4)
+
+            t = util.TimerDev("cataloging %d walls of %d routes, %s" % (
+                    wallCount, routeCount,
+                    withSnapshots and "with snapshots" or "XML only"))
+            ws.addDir(dirname)
+            del t
+
+            t = util.TimerDev("opening each wall twice")
+
+            for wallId in ids + ids:
+                cw = ws.open(wallId)
+
+            del t
+
+            print "  %d walls in memory, estimated %d KB" % (
+                len(ws.cache), ws.memoryUsage() // 1024)
+
+    finally:
+        for fname in os.listdir(dirname):
+            os.remove(os.path.join(dirname, fname))
+
+        os.rmdir(dirname)
+
+# cost of finding who has lead-climbed a route, from a ProfileStore and
+# by loading every profile's XML file
+def benchStore():
+    profileCount = 300
+    ascents = 300
+
+    rnd = random.Random(29)
+    cw = createWall(2000)
+
+    dirname = tempfile.mkdtemp()
+
+    try:
+        store = cwall.ProfileStore(os.path.join(dirname, "profiles.db"))
+        xmlDatas = []
+
+        for i in xrange(profileCount):
+            cp = cwall.ClimbingProfile()
+            cp.name = "climber%d" % i
+
+            for route in rnd.sample(cw.routes, ascents):
+                rp = cp.getRouteProfile(cw.id, route.id, True)
+                rp.leadClimbed = randomDate(rnd)
+
+            store.saveProfile(cp)
+            xmlDatas.append(toXml(cp))
+
+        routeIds = [route.id for route in rnd.sample(cw.routes, 10)]
+        mask = (cwall.RouteProfile.LEAD_CLIMBED |
+                cwall.RouteProfile.LEAD_CLIMBED_FALL)
+
+        t = util.TimerDev("%d profiles, %d routes' climbers from XML" % (
+                profileCount, len(routeIds)))
+
+        climbers = dict((routeId, []) for routeId in routeIds)
+
+        for data in xmlDatas:
+            cp = cwall.ClimbingProfile.load(data)
+
+            for routeId in routeIds:
+                rp = cp.getRouteProfile(cw.id, routeId)
+
+                if rp and (rp.flags() & mask):
+                    climbers[routeId].append(cp.name)
+
+        del t
+
+        t = util.TimerDev("%d profiles, %d routes' climbers from store" % (
+                profileCount, len(routeIds)))
+
+        for routeId in routeIds:
+            store.getRouteAscents(cw.id, routeId, mask)
+
+        del t
+
+        store.close()
+
+    finally:
+        for fname in os.listdir(dirname):
+            os.remove(os.path.join(dirname, fname))
+
+        os.rmdir(dirname)
+
+# an old-style, dict-backed class like Point, Wall and Route used to be
+class DictObject:
+    pass
+
+# return memory used by obj itself (not including what its attributes
+# point to), in bytes
+def objectSize(obj):
+    size = sys.getsizeof(obj)
+
+    if hasattr(obj, "__dict__"):
+        size += sys.getsizeof(obj.__dict__)
+
+    return size
+
+# memory used by the geometry model, compared to dict-backed objects
+def benchMemory():
+    gyms = [createWall(5000) for i in xrange(5)]
+
+    for name, getObjects in (
+        ("Point", lambda cw: cw.walls.points),
+        ("Wall", lambda cw: cw.walls.walls),
+        ("Route", lambda cw: cw.routes)):
+
+        count = 0
+        slotSize = 0
+        dictSize = 0
+
+        for cw in gyms:
+            for obj in getObjects(cw):
+                d = DictObject()
+
+                for attr in obj.__slots__:
+                    setattr(d, attr, getattr(obj, attr))
+
+                count += 1
+                slotSize += objectSize(obj)
+                dictSize += objectSize(d)
+
+        print "%d %ss: %.1f KB with __slots__, %.1f KB dict-backed" % (
+            count, name, slotSize / 1024.0, dictSize / 1024.0)
+
+# return random util.Date in the years 2008-2010
+def randomDate(rnd):
+    return util.Date.fromYMD(rnd.randint(2008, 2010), rnd.randint(1, 12),
+                             rnd.randint(1, 28))
+
+# cost of recalculating the active routes after a filter setting changes
+def benchFilter():
+    updates = 20
+    routeCount = 10000
+
+    cw = createWall(routeCount)
+
+    rnd = random.Random(7)
+    cwProf = cwall.ClimbingWallProfile(cw.id)
+    cwall.M.profile.cwProfiles[cw.id] = cwProf
+
+    for route in cw.routes:
+        route.rating = rnd.choice(cwall.Rating.RATINGS)
+        route.dateAdded = randomDate(rnd)
+
+        if rnd.random() < 0.5:
+            route.dateRemoved = randomDate(rnd)
+
+        if rnd.random() < 0.3:
+            rp = cwProf.getRouteProfile(route.id, True)
+            rp.toproped = randomDate(rnd)
+
+    cw.rebuildAttrIndex()
+    cwall.M.showDeletedCb.setChecked(False)
+
+    t = util.TimerDev("%d filter updates, %d routes" % (updates, routeCount))
+
+    for i in xrange(updates):
+        cw.updateRouteFilter()
+
+    del t
+
+    cwall.M.showDeletedCb.setChecked(True)
+
+# cost of updating the active routes after single routes are edited,
+# compared to refiltering all routes after each edit
+def benchEdit():
+    edits = 1000
+    routeCount = 10000
+
+    cw = createWall(routeCount)
+
+    rnd = random.Random(3)
+    cwall.Rating.RATINGS[0].checkbox.setChecked(False)
+    cw.updateRouteFilter()
+
+    routes = [rnd.choice(cw.routes) for i in xrange(edits)]
+    ratings = [rnd.choice(cwall.Rating.RATINGS[:2]) for i in xrange(edits)]
+
+    t = util.TimerDev("%d single route edits, %d routes" % (
+            edits, routeCount))
+
+    for route, rating in zip(routes, ratings):
+        route.rating = rating
+        cw.routeChanged(route)
+
+    del t
+
+    t = util.TimerDev("%d full filter updates, %d routes" % (
+            edits // 10, routeCount))
+
+    for i in xrange(edits // 10):
+        cw.updateRouteFilter()
+
+    del t
+
+    cwall.Rating.RATINGS[0].checkbox.setChecked(True)
+
+# cost of finding the routes that existed at each date when scrubbing
+# through a gym's history one day at a time, compared to checking every
+# route's lifetime for each date
+def benchHistory():
+    routeCount = 10000
+
+    cw = createWall(routeCount)
+
+    rnd = random.Random(11)
+
+    for route in cw.routes:
+        route.dateAdded = randomDate(rnd)
+
+        if rnd.random() < 0.8:
+            route.dateRemoved = randomDate(rnd)
+
+            if route.dateRemoved < route.dateAdded:
+                route.dateAdded, route.dateRemoved = (
+                    route.dateRemoved, route.dateAdded)
+
+    cw.rebuildAttrIndex()
+
+    first = cw.attrIndex.lifetimes.first()
+    dates = range(first, first + 3 * 365)
+
+    t = util.TimerDev("%d dates, %d routes, index" % (len(dates), routeCount))
+
+    for d in dates:
+        cw.attrIndex.existedAt(d)
+
+    del t
+
+    dates = dates[::10]
+
+    t = util.TimerDev("%d dates, %d routes, Route.existedAt" % (
+            len(dates), routeCount))
+
+    for d in dates:
+        date = util.Date.fromOrdinal(d)
+        [r for r in cw.routes if r.existedAt(date)]
+
+    del t
+
+# cost of painting routes at different zoom levels, with only what's
+# visible in a 1600x1200 window painted. when zoomed out far enough to use
+# a lower level of detail, the cost of painting at full detail is also
+# shown for comparison.
+def benchZoom():
+    paints = 10
+    width = 1600
+    height = 1200
+
+    cw = createWall(10000)
+
+    img = QtGui.QImage(width, height, QtGui.QImage.Format_ARGB32_Premultiplied)
+
+    for scale in (0.05, 0.12, 0.5, 1.0, 2.0):
+        cwall.M.viewportScale = scale
+        rect = QtCore.QRectF(0, 0, width / scale, height / scale)
+
+        details = [cwall.getDetailLevel()]
+
+        if details[0] != cwall.DETAIL_FULL:
+            details.append(cwall.DETAIL_FULL)
+
+        for detail in details:
+            t = util.TimerDev("%d paints, 10000 routes, zoom %.2f, "
+                              "detail %d" % (paints, scale, detail))
+
+            for i in xrange(paints):
+                pnt = QtGui.QPainter()
+                pnt.begin(img)
+                pnt.scale(scale, scale)
+                cw.paintRoutes(pnt, rect, detail)
+                pnt.end()
+
+            del t
+
+BENCHMARKS = [
+    ("closest", benchClosest),
+    ("drag", benchDrag),
+    ("paint", benchPaint),
+    ("zoom", benchZoom),
+    ("filter", benchFilter),
+    ("edit", benchEdit),
+    ("history", benchHistory),
+    ("load", benchLoad),
+    ("profile", benchProfile),
+    ("binary", benchBinary),
+    ("snapshot", benchSnapshot),
+    ("journal", benchJournal),
+    ("workspace", benchWorkspace),
+    ("store", benchStore),
+    ("memory", benchMemory),
+    ]
+
+# create the filter widgets that ClimbingWall.updateRouteFilter needs,
+# set up so that every route passes
+def createFilters():
+    M = cwall.M
+
+    M.showDeletedCb = QtGui.QCheckBox("Show deleted routes")
+    M.showDeletedCb.setChecked(True)
+
+    M.historyCb = QtGui.QCheckBox("Show routes at:")
+
+    for rating in cwall.Rating.RATINGS:
+        if not rating.fractional:
+            rating.checkbox = QtGui.QCheckBox(rating.text)
+            rating.checkbox.setChecked(True)
+
+    for obj in cwall.COLORS + cwall.Marker.MARKERS:
+        obj.checkbox = QtGui.QCheckBox(obj.name)
+        obj.checkbox.setChecked(True)
+
+    hbox = QtGui.QHBoxLayout()
+
+    M.includeFilter = cwall.Filter(True, hbox, None)
+    M.includeFilter.allCB.setChecked(True)
+
+    M.excludeFilter = cwall.Filter(False, hbox, None)
+
+def main():
+    app = QtGui.QApplication(sys.argv)
+
+    cwall.M = cwall.Main()
+    cwall.M.w = cwall.MyWidget()
+    createFilters()
+
+    names = sys.argv[1:]
+
+    for name, func in BENCHMARKS:
+        if not names or (name in names):
+            print "%s:" % name
+            func()
+
+main()
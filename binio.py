@@ -0,0 +1,152 @@
+import util
+
+import array, binascii, struct, sys
+
+# NumPy is optional, it's only used for reading arrays in place
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# helpers for reading and writing binary files. all values are stored in
+# little-endian byte order. arrays use the typecodes of the array module,
+# with "B" (uint8), "i" (int32), "I" (uint32) and "d" (float64) being the
+# ones with a fixed size on all platforms we care about.
+
+# writes values to a list of strings, which getData() joins together
+class Writer:
+    def __init__(self):
+        self.parts = []
+
+    def getData(self):
+        return "".join(self.parts)
+
+    def write(self, fmt, *values):
+        self.parts.append(struct.pack("<" + fmt, *values))
+
+    def writeUInt32(self, val):
+        self.write("I", val)
+
+    # write file header consisting of 4-byte magic string and version
+    def writeHeader(self, magic, version):
+        self.parts.append(magic)
+        self.writeUInt32(version)
+
+    # write a string as a length followed by its UTF-8 encoding
+    def writeString(self, s):
+        s = s.encode("UTF-8")
+
+        self.writeUInt32(len(s))
+        self.parts.append(s)
+
+    # write list of UUIDs, as 16 bytes each
+    def writeUUIDs(self, uuids):
+        self.parts.append(binascii.unhexlify("".join(uuids)))
+
+    def writeUUID(self, uuid):
+        self.writeUUIDs([uuid])
+
+    # write sequence of values as an array of given typecode. the length
+    # is not written, so it must be known when reading.
+    def writeArray(self, typecode, values):
+        arr = array.array(typecode, values)
+
+        if sys.byteorder != "little":
+            arr.byteswap()
+
+        self.parts.append(arr.tostring())
+
+# reads values from a string (or anything else supporting len() and
+# slicing, like an mmap object), throwing error.ConfigError if there is not
+# enough data left
+class Reader:
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    # return next 'size' bytes
+    def readBytes(self, size):
+        util.cfgAssert(self.pos + size <= len(self.data), "Truncated file")
+
+        s = self.data[self.pos:self.pos + size]
+        self.pos += size
+
+        return s
+
+    # skip next 'size' bytes
+    def skip(self, size):
+        util.cfgAssert(self.pos + size <= len(self.data), "Truncated file")
+
+        self.pos += size
+
+    # return tuple of values
+    def read(self, fmt):
+        fmt = "<" + fmt
+
+        return struct.unpack(fmt, self.readBytes(struct.calcsize(fmt)))
+
+    def readUInt32(self):
+        return self.read("I")[0]
+
+    # read and check file header written by Writer.writeHeader, returning
+    # the version. maxVersion is the newest version we understand.
+    def readHeader(self, magic, maxVersion):
+        util.cfgAssert(self.readBytes(len(magic)) == magic,
+                       "Not a valid file")
+
+        version = self.readUInt32()
+
+        util.cfgAssert(version > 0, "Invalid version")
+
+        util.cfgAssert(version <= maxVersion,
+                       "File uses a newer format than this program recognizes."
+                       " Please upgrade your program.")
+
+        return version
+
+    def readString(self):
+        s = self.readBytes(self.readUInt32())
+
+        try:
+            return s.decode("UTF-8")
+        except UnicodeDecodeError:
+            util.cfgAssert(0, "Invalid string")
+
+    # read list of count UUIDs
+    def readUUIDs(self, count):
+        s = binascii.hexlify(self.readBytes(count * 16))
+
+        return [s[i:i + 32] for i in xrange(0, len(s), 32)]
+
+    def readUUID(self):
+        return self.readUUIDs(1)[0]
+
+    # read array of count values of given typecode
+    def readArray(self, typecode, count):
+        arr = array.array(typecode)
+        arr.fromstring(self.readBytes(count * arr.itemsize))
+
+        if sys.byteorder != "little":
+            arr.byteswap()
+
+        return arr
+
+    # like readArray, but if NumPy is available, returns a read-only NumPy
+    # array that uses the data in place instead of copying it
+    def readArrayView(self, typecode, count):
+        if numpy is None:
+            return self.readArray(typecode, count)
+
+        dtype = numpy.dtype("<" + typecode)
+        size = count * dtype.itemsize
+
+        util.cfgAssert(self.pos + size <= len(self.data), "Truncated file")
+
+        arr = numpy.frombuffer(self.data, dtype, count, self.pos)
+        self.pos += size
+
+        return arr
+
+    # return True if all data has been read
+    def atEnd(self):
+        return self.pos == len(self.data)
@@ -4,14 +4,25 @@
 from __future__ import with_statement
 
 import error
+import binio
 import gutil
+import interval
+import journal
+import spatial
 import util
 
-import sys, random, math, operator
+import bisect, sys, random, math, mmap, operator, itertools, os, string
+import collections, copy, sqlite3
 
 import lxml.etree as etree
 from PyQt4 import QtGui, QtCore
 
+# NumPy is optional, it's only used to speed up some bulk operations
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 QRectF = QtCore.QRectF
 QPointF = QtCore.QPointF
 QLineF = QtCore.QLineF
@@ -25,17 +36,76 @@ SQRT_2 = math.sqrt(2)
 # numbers. all user-exposed numbers are in meters though.
 SCALE = 100.0
 
+# climbing wall file, a binary format snapshot of it that is opened
+# instead when it's up to date, and the journal of changes made to it
+# since it was last saved, see Main.loadCW
+CW_FILE = "pump2.xml"
+CW_SNAPSHOT_FILE = "pump2.snapshot"
+CW_JOURNAL_FILE = "pump2.journal"
+
+# FIXME: can't use fixed filenames
+# climbing profile file, and the journal of changes made to it since it
+# was last saved
+PROFILE_FILE = "osku.xml"
+PROFILE_JOURNAL_FILE = "osku.journal"
+
+# how often changes are written to the journals, in seconds
+AUTOSAVE_INTERVAL = 30
+
+# filename extensions of climbing wall files, their binary format
+# snapshots and journals, see Workspace
+XML_EXT = ".xml"
+SNAPSHOT_EXT = ".snapshot"
+JOURNAL_EXT = ".journal"
+
+# default memory budget of a Workspace, in bytes
+WORKSPACE_MEMORY_BUDGET = 256 * 1024 * 1024
+
+# rough memory use of a ClimbingWall, in bytes, per wall segment, per route
+# and per Route object created, see ClimbingWall.memoryUsage
+WALL_MEMORY = 500
+ROUTE_MEMORY = 700
+ROUTE_OBJECT_MEMORY = 400
+
 # size of small marker circles, in pixels
 CIRCLE_SIZE = 8
 
 # size of small marker rectangles
 RECTANGLE_SIZE = 20
 
+# levels of detail for painting walls and routes, see getDetailLevel:
+#  DETAIL_DOTS: routes are colored dots, no texts are drawn at all
+#  DETAIL_SIMPLE: routes are plain colored squares without labels
+#  DETAIL_FULL: everything is drawn
+DETAIL_DOTS, DETAIL_SIMPLE, DETAIL_FULL = range(3)
+
+# viewport scales below which DETAIL_DOTS / DETAIL_SIMPLE are used. at
+# these scales route labels would be under 2 / 3 pixels tall.
+DETAIL_DOTS_SCALE = 0.1
+DETAIL_SIMPLE_SCALE = 0.15
+
+# size of route dots / squares in lower levels of detail, in pixels
+DOT_SIZE = 4
+
+# how far, in logical coordinates, things drawn for a wall or route (wall
+# length texts, route labels and markers) can extend from the wall / route
+# position
+PAINT_MARGIN = 250.0
+
+# size of spatial index grid cells, in logical coordinates. routes are
+# packed more densely than walls, so they use smaller cells.
+GRID_SIZE = 100.0
+ROUTE_GRID_SIZE = 50.0
+
+# fonts, as (family, pixel size) tuples to be passed to gutil.getFont
+
 # font for displaying information about walls such as length etc
-WALL_FONT = QtGui.QFont("Courier New", 18)
-WALL_FONT.setPixelSize(48)
+WALL_FONT = ("Courier New", 48)
+
+# font for displaying route ratings
+ROUTE_FONT = ("Courier New Bold", 18)
 
-class Color:
+class Color(object):
     def __init__(self, name, r, g, b):
         self.name = name
         self.r = r
@@ -44,16 +114,19 @@ class Color:
 
         self.brush = QtGui.QBrush(QtGui.QColor(r, g, b))
 
+        # the filter QCheckBox item associated with us
+        self.checkbox = None
+
     def save(self):
         return self.name
 
     @staticmethod
     def load(s):
-        for c in COLORS:
-            if c.name == s:
-                return c
+        c = COLORS_BY_NAME.get(s)
+
+        util.cfgAssert(c, "Unknown color '%s'" % s)
 
-        util.cfgAssert(0, "Unknown color '%s'" % s)
+        return c
 
 # FIXME: move inside Color
 COLORS = [
@@ -70,10 +143,16 @@ COLORS = [
     Color("Black", 0, 0, 0)
 ]
 
-class Rating:
+# key = name, value = Color
+COLORS_BY_NAME = dict((c.name, c) for c in COLORS)
+
+class Rating(object):
     # all possible Rating objects, ordered from easiest to hardest
     RATINGS = []
 
+    # key = text, value = Rating
+    BY_TEXT = {}
+
     def __init__(self, text, compareIdx, fractional):
         # textual representation, e.g. "5.4" or "5.10a"
         self.text = text
@@ -111,18 +190,21 @@ class Rating:
                 s = it
                 fractional = False
 
-            Rating.RATINGS.append(Rating(s, len(Rating.RATINGS), fractional))
+            r = Rating(s, len(Rating.RATINGS), fractional)
+
+            Rating.RATINGS.append(r)
+            Rating.BY_TEXT[s] = r
 
     def save(self):
         return self.text
 
     @staticmethod
     def load(s):
-        for r in Rating.RATINGS:
-            if r.text == s:
-                return r
+        r = Rating.BY_TEXT.get(s)
 
-        util.cfgAssert(0, "Unknown rating '%s'" % s)
+        util.cfgAssert(r, "Unknown rating '%s'" % s)
+
+        return r
 
 Rating.add([
         ("5.4",), ("5.5"), ("5.6"), ("5.7"), ("5.8"), ("5.9"),
@@ -179,22 +261,240 @@ class Filter:
 
         setattr(self, name, cb)
 
-    # return True if given RouteProfile matches this filter. if rp is
-    # None, it only matches if we are an include filter and "All" is
-    # selected.
-    def matches(self, rp):
-       if self.isInclude and self.allCB.isChecked():
-            return True
+    # return (matchesAll, mask) tuple describing the current state of the
+    # filter. matchesAll is True if everything, including routes with no
+    # RouteProfile, matches the filter. otherwise a RouteProfile matches
+    # if its flags() have any bit of mask set.
+    def compile(self):
+        if self.isInclude and self.allCB.isChecked():
+            return (True, 0)
+
+        mask = 0
+
+        for cb, flag in (
+            (self.topropedCB, RouteProfile.TOPROPED),
+            (self.topropedFallCB, RouteProfile.TOPROPED_FALL),
+            (self.leadClimbedCB, RouteProfile.LEAD_CLIMBED),
+            (self.leadClimbedFallCB, RouteProfile.LEAD_CLIMBED_FALL)):
+
+            if cb.isChecked():
+                mask |= flag
+
+        return (False, mask)
+
+# snapshot of all route filter settings (ratings, include/exclude filters,
+# showing of deleted routes), taken once so that filtering the routes
+# doesn't need to look at any widgets. routes are filtered through their
+# RouteAttrIndex entries, which include their profile flags.
+class RouteFilter:
+    def __init__(self):
+        # indexed by Rating.compareIdx, True if rating is active
+        self.ratings = [r.isActive() for r in Rating.RATINGS]
+
+        # active Colors and Markers
+        self.colors = set(c for c in COLORS if c.checkbox.isChecked())
+        self.markers = set(m for m in Marker.MARKERS if m.checkbox.isChecked())
+
+        self.includeAll, self.includeMask = M.includeFilter.compile()
+        self.excludeMask = M.excludeFilter.compile()[1]
+
+        # date ordinal that routes must have existed at, or None if
+        # deleted routes are shown
+        if M.historyCb.isChecked():
+            self.today = M.historySlider.value()
+        elif M.showDeletedCb.isChecked():
+            self.today = None
+        else:
+            self.today = util.Date.now().toOrdinal()
+
+    # return True if a route indexed under given RouteAttrIndex key passes
+    # the filter. this goes through bits, so that a single route is judged
+    # exactly like all of them are.
+    def matchesKey(self, key):
+        index = RouteAttrIndex()
+        index.set(0, key)
+
+        return bool(self.bits(index))
+
+    # return bitset of the routes that pass the filter, using given
+    # RouteAttrIndex
+    def bits(self, index):
+        ret = index.any(index.ratings,
+                        [r for r in Rating.RATINGS if self.ratings[r.compareIdx]])
+        ret &= index.any(index.colors, self.colors)
+        ret &= index.any(index.markers, self.markers)
+
+        if not self.includeAll:
+            ret &= index.anyFlag(self.includeMask)
+
+        if self.excludeMask:
+            ret &= ~index.anyFlag(self.excludeMask)
+
+        if self.today is not None:
+            ret &= index.existedAt(self.today)
+
+        return ret
+
+
+# bitmap indexes over the attributes of a ClimbingWall's routes that are
+# used in filtering. a bitset is a Python integer with bit N set if the
+# route whose sequence number (see ClimbingWall.routeSeq) is N is in the
+# set.
+class RouteAttrIndex:
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        # bitset of all routes
+        self.all = 0
+
+        # key = Rating / Color / Marker, value = bitset of routes with
+        # that attribute value
+        self.ratings = {}
+        self.colors = {}
+        self.markers = {}
+
+        # key = RouteProfile flag, value = bitset of routes with that flag
+        # set in their profile
+        self.flags = {}
+
+        # key = sequence number, value = (rating, color, marker, flags,
+        # dateAdded, dateRemoved) tuple the route is currently indexed
+        # under, the dates being ordinals or None
+        self.keys = {}
+
+        # lifetimes of routes, as [dateAdded, dateRemoved) intervals of
+        # date ordinals
+        self.lifetimes = interval.EndpointIndex()
+
+    # return the key (see 'keys') to index route under, rp being its
+    # RouteProfile or None
+    @staticmethod
+    def makeKey(route, rp):
+        if rp:
+            flags = rp.flags()
+        else:
+            flags = 0
+
+        return (route.rating, route.color, route.marker, flags,
+                route.dateAdded and route.dateAdded.toOrdinal(),
+                route.dateRemoved and route.dateRemoved.toOrdinal())
+
+    # index route with given sequence number under given key. if the route
+    # has already been indexed, the index is updated to match the new key.
+    def set(self, seq, key):
+        oldKey = self.keys.get(seq)
+
+        if key == oldKey:
+            return
+
+        if oldKey:
+            self.toggle(seq, oldKey)
+
+        self.toggle(seq, key)
+        self.keys[seq] = key
+
+        if (oldKey is None) or (key[4:] != oldKey[4:]):
+            self.lifetimes.set(seq, *key[4:])
+
+    # replace the contents of the index with given keys, which is a list
+    # indexed by sequence number. this is the same as calling clear and
+    # then set for each route, but a lot faster for large numbers of
+    # routes.
+    def load(self, keys):
+        self.clear()
+
+        # key = (rating, color, marker, flags), value = list of sequence
+        # numbers. there are far fewer of these than routes, so the
+        # per-attribute lists are best built from these.
+        groups = {}
+
+        for seq, key in enumerate(keys):
+            groups.setdefault(key[:4], []).append(seq)
+
+        # lists of sequence numbers, keyed like ratings/colors/markers/flags
+        ratings = {}
+        colors = {}
+        markers = {}
+        flags = {}
+
+        for (rating, color, marker, routeFlags), seqs in groups.iteritems():
+            ratings.setdefault(rating, []).extend(seqs)
+            colors.setdefault(color, []).extend(seqs)
+            markers.setdefault(marker, []).extend(seqs)
+
+            for flag in RouteProfile.FLAGS:
+                if routeFlags & flag:
+                    flags.setdefault(flag, []).extend(seqs)
+
+        for d, seqLists in ((self.ratings, ratings), (self.colors, colors),
+                            (self.markers, markers), (self.flags, flags)):
+            for val, seqs in seqLists.iteritems():
+                d[val] = RouteAttrIndex.makeBits(seqs, len(keys))
+
+        self.all = RouteAttrIndex.makeBits(xrange(len(keys)), len(keys))
+        self.keys = dict(enumerate(keys))
+        self.lifetimes.load((seq, key[4], key[5])
+                            for seq, key in enumerate(keys))
+
+    # flip route's bit in the bitsets of the given key
+    def toggle(self, seq, key):
+        bit = 1 << seq
+
+        rating, color, marker, flags = key[:4]
+
+        for d, val in ((self.ratings, rating), (self.colors, color),
+                       (self.markers, marker)):
+            d[val] = d.get(val, 0) ^ bit
+
+        for flag in RouteProfile.FLAGS:
+            if flags & flag:
+                self.flags[flag] = self.flags.get(flag, 0) ^ bit
+
+        self.all ^= bit
 
-       if not rp:
-           return False
+    # return union of the bitsets in d (one of ratings/colors/markers) for
+    # given values
+    def any(self, d, values):
+        ret = 0
 
-       return (
-           (self.topropedCB.isChecked() and rp.toproped) or
-           (self.leadClimbedCB.isChecked() and rp.leadClimbed) or
-           (self.topropedFallCB.isChecked() and rp.topropedFall) or
-           (self.leadClimbedFallCB.isChecked() and rp.leadClimbedFall))
+        for val in values:
+            ret |= d.get(val, 0)
 
+        return ret
+
+    # return bitset of routes having any of the RouteProfile flags in mask
+    def anyFlag(self, mask):
+        return self.any(self.flags,
+                        [f for f in RouteProfile.FLAGS if f & mask])
+
+    # return bitset of routes that existed at given date ordinal
+    def existedAt(self, today):
+        return self.lifetimes.at(today)
+
+    # return bitset of given sequence numbers, all of which are smaller
+    # than count
+    @staticmethod
+    def makeBits(seqs, count):
+        s = bytearray(count)
+
+        for seq in seqs:
+            s[seq] = 1
+
+        # reversed binary string has bit N in position N
+        return int(str(s).translate(BYTES_TO_BITS)[::-1] or "0", 2)
+
+    # return sorted list of the sequence numbers in given bitset
+    @staticmethod
+    def seqs(bits):
+        s = bin(bits)[:1:-1].translate(BITS_TO_BYTES)
+
+        return list(itertools.compress(itertools.count(), bytearray(s)))
+
+# translation tables for turning "0"/"1" characters into 0/1 bytes and
+# back
+BITS_TO_BYTES = string.maketrans("01", "\x00\x01")
+BYTES_TO_BITS = string.maketrans("\x00\x01", "01")
 
 # misc globally needed stuff
 class Main:
@@ -226,6 +526,15 @@ class Main:
         # whether to show wall lengths checkbox
         self.showWallLengthsCb = None
 
+        # whether to show deleted routes checkbox
+        self.showDeletedCb = None
+
+        # history mode checkbox, and the slider (values being date
+        # ordinals) and label for the date to show routes at in that mode
+        self.historyCb = None
+        self.historySlider = None
+        self.historyLabel = None
+
         # Filter include/exclude objects
         self.includeFilter = None
         self.excludeFilter = None
@@ -239,6 +548,16 @@ class Main:
         # current climbing profile
         self.profile = ClimbingProfile()
 
+        # journals of changes made to CW and profile since they were last
+        # saved
+        self.cwJournal = journal.Journal(CW_JOURNAL_FILE)
+        self.profileJournal = journal.Journal(PROFILE_JOURNAL_FILE)
+
+        # util.SaveThread of the save in progress, or None, and the
+        # function to call with True/False (success) once it has finished
+        self.saveThread = None
+        self.saveDone = None
+
         self.clear()
 
     def clear(self, initTime = True):
@@ -262,48 +581,248 @@ class Main:
         self.mode = None
 
     def saveCW(self):
-        CW.save()
+        self.startFullSave(CW, self.cwJournal, self.cwSaved)
+
+    def cwSaved(self, ok):
+        if ok:
+            self.discardOldJournal(self.cwJournal)
 
     def loadCW(self):
         global CW
 
-        data = util.loadFile("pump2.xml", self.mw)
+        self.autosave()
+        self.waitForSave()
 
-        if data is None:
+        cw = self.loadCWSnapshot()
+
+        if cw is None:
+            f = util.openFile(CW_FILE, self.mw)
+
+            if f is None:
+                return
+
+            try:
+                cw = ClimbingWall.load(f)
+
+            except error.ConfigError, e:
+                QtGui.QMessageBox.critical(
+                    self.mw, "Error", "Error loading file '%s': %s" % (
+                        CW_FILE, e))
+
+                return
+
+            finally:
+                f.close()
+
+            self.writeCWSnapshot(cw)
+
+        if not self.applyJournal(cw, self.cwJournal):
             return
 
         try:
-            CW = ClimbingWall.load(data)
-            M.clear(False)
-            M.calcMousePos()
-            M.setMode(RouteEditMode, True)
+            self.profile.getWallProfile(cw.id)
 
         except error.ConfigError, e:
             QtGui.QMessageBox.critical(
                 self.mw, "Error", "Error loading file '%s': %s" % (
-                    "pump2.xml", e))
+                    PROFILE_FILE, e))
+
+            return
+
+        self.cwJournal.active = True
+
+        CW = cw
+        CW.updateRouteFilter()
+        M.updateHistoryRange()
+        M.clear(False)
+        M.calcMousePos()
+        M.setMode(RouteEditMode, True)
+        M.w.invalidateStatic()
+
+    # return ClimbingWall opened from CW_SNAPSHOT_FILE, or None if it does
+    # not exist, is older than CW_FILE, or can't be used for some other
+    # reason. the snapshot is only a cache of CW_FILE, which is then loaded
+    # instead.
+    def loadCWSnapshot(self):
+        return openFreshSnapshot(CW_FILE, CW_SNAPSHOT_FILE)
+
+    # write snapshot of cw, which has just been loaded from CW_FILE, to
+    # CW_SNAPSHOT_FILE. failures are ignored, as the snapshot is only a
+    # cache.
+    def writeCWSnapshot(self, cw):
+        try:
+            cw.writeSnapshot(CW_SNAPSHOT_FILE)
+        except EnvironmentError:
+            pass
 
     def saveProfile(self):
-        self.profile.save()
+        self.startFullSave(self.profile, self.profileJournal,
+                           self.profileSaved)
+
+    def profileSaved(self, ok):
+        if ok:
+            self.discardOldJournal(self.profileJournal)
+
+            # FIXME: debug stuff, remove
+            print "saved profile %s" % PROFILE_FILE
 
     def loadProfile(self):
-        # FIXME: can't use a fixed filename
-        data = util.loadFile("osku.xml", self.mw)
+        self.autosave()
+        self.waitForSave()
+
+        data = util.loadFile(PROFILE_FILE, self.mw)
 
         if data is None:
             return
 
         try:
-            self.profile = ClimbingProfile.load(data)
-            self.updateRouteFilter()
+            profile = ClimbingProfile.load(data)
 
-            # FIXME: debug stuff, remove
-            print "loaded profile osku.xml"
+            # the rest of the walls' profiles are only loaded when needed
+            profile.getWallProfile(CW.id)
 
         except error.ConfigError, e:
             QtGui.QMessageBox.critical(
                 self.mw, "Error", "Error loading file '%s': %s" % (
-                    "osku.xml", e))
+                    PROFILE_FILE, e))
+
+            return
+
+        if not self.applyJournal(profile, self.profileJournal):
+            return
+
+        self.profileJournal.active = True
+
+        oldProfile = self.profile
+        self.profile = profile
+        CW.profileReplaced(oldProfile)
+        self.updateRouteFilter()
+
+        # FIXME: debug stuff, remove
+        print "loaded profile %s" % PROFILE_FILE
+
+    # apply the changes in jrnl to obj (ClimbingWall or ClimbingProfile)
+    # that has just been loaded. returns False (after popping up a message
+    # box) on errors.
+    def applyJournal(self, obj, jrnl):
+        try:
+            obj.applyJournal(jrnl.read())
+
+            return True
+
+        except EnvironmentError, (errno, strerror):
+            QtGui.QMessageBox.critical(
+                self.mw, "Error", "Error loading file '%s': %s" % (
+                    jrnl.filename, strerror))
+
+        except error.ConfigError, e:
+            QtGui.QMessageBox.critical(
+                self.mw, "Error", "Error loading file '%s': %s" % (
+                    jrnl.filename, e))
+
+        return False
+
+    # write changes made to CW and profile since the last time this was
+    # called to their journals. nothing is written for something that has
+    # not been loaded from or saved to a file yet.
+    def autosave(self):
+        for obj, jrnl in ((CW, self.cwJournal),
+                          (self.profile, self.profileJournal)):
+            if jrnl.active:
+                self.writeJournal(obj, jrnl)
+
+    # write changes made to obj (ClimbingWall or ClimbingProfile) to its
+    # journal jrnl. returns False (after popping up a message box) on
+    # errors, in which case the changes are tried again the next time.
+    def writeJournal(self, obj, jrnl):
+        try:
+            jrnl.append(obj.getJournalEntries())
+            obj.journalWritten()
+
+            return True
+
+        except EnvironmentError, (errno, strerror):
+            QtGui.QMessageBox.critical(
+                self.mw, "Error", "Error writing file '%s': %s" % (
+                    jrnl.filename, strerror))
+
+            return False
+
+    # save obj (ClimbingWall or ClimbingProfile) in full in the background.
+    # everything up to now is written to the journal jrnl first, and the
+    # journal is then moved aside, so that until the save has finished,
+    # the old file and the old journal together still have all of the
+    # changes. done is called as for startSave.
+    def startFullSave(self, obj, jrnl, done):
+        self.waitForSave()
+
+        if jrnl.active and not self.writeJournal(obj, jrnl):
+            return
+
+        try:
+            jrnl.rotate()
+
+        except EnvironmentError, (errno, strerror):
+            QtGui.QMessageBox.critical(
+                self.mw, "Error", "Error writing file '%s': %s" % (
+                    jrnl.filename, strerror))
+
+            return
+
+        # if obj did not come from the file, its changes so far only go in
+        # the full save
+        obj.journalWritten()
+        jrnl.active = True
+
+        self.startSave(obj.getSaveWork(), done)
+
+    # delete the journal entries moved aside by startFullSave
+    def discardOldJournal(self, jrnl):
+        try:
+            jrnl.discardOld()
+
+        except EnvironmentError, (errno, strerror):
+            QtGui.QMessageBox.critical(
+                self.mw, "Error", "Error deleting file '%s': %s" % (
+                    jrnl.oldFilename, strerror))
+
+    # write files in the background using util.SaveThread, waiting for any
+    # save still in progress first so saves happen in order. done(ok) is
+    # called once the files have been written, ok being False if there
+    # were errors (the user has been told about them already).
+    def startSave(self, work, done):
+        self.waitForSave()
+
+        self.saveThread = util.SaveThread(work, self.mw)
+        self.saveDone = done
+
+        QtCore.QObject.connect(self.saveThread, QtCore.SIGNAL("finished()"),
+                               self.saveFinished)
+
+        self.saveThread.start()
+
+    # wait for the save in progress, if any, to finish
+    def waitForSave(self):
+        if self.saveThread:
+            self.saveThread.wait()
+            self.saveFinished()
+
+    def saveFinished(self):
+        thread = self.saveThread
+
+        # the finished() signal of a thread already handled by
+        # waitForSave, or of a thread that has been started by it
+        if not thread or not thread.isFinished():
+            return
+
+        self.saveThread = None
+
+        if thread.error:
+            QtGui.QMessageBox.critical(
+                self.mw, "Error", "Error writing file '%s': %s" % (
+                    thread.error))
+
+        self.saveDone(not thread.error)
 
     def setMode(self, modeClass, setCombo):
         if modeClass is self.modeClass:
@@ -325,25 +844,47 @@ class Main:
         self.setMode(self.modeCombo.itemData(
                 self.modeCombo.currentIndex()).toPyObject(), False)
 
-    def updateRouteFilter(self):
-        CW.updateRouteFilter()
+    # history mode has been turned on/off
+    def historyToggled(self):
+        if self.historyCb.isChecked():
+            self.updateHistoryRange()
 
-        self.mode.moveEvent()
-        self.w.update()
+        self.historySlider.setEnabled(self.historyCb.isChecked())
+        self.updateRouteFilter()
 
-    # return true if given route should be displayed according to current
-    # profile filtering settings
-    def routeInProfileFilter(self, wallId, routeId):
-        rp = self.profile.getRouteProfile(wallId, routeId, False)
+    # set history slider's range to go from the oldest date in the current
+    # climbing wall to today. must be called after a route's dates have
+    # been changed. if the slider was at the end of its range, it's moved
+    # to the new end, so it keeps showing today even past midnight.
+    def updateHistoryRange(self):
+        today = util.Date.now().toOrdinal()
+        first = CW.attrIndex.lifetimes.first()
 
-        include = self.includeFilter.matches(rp)
+        if (first is None) or (first > today):
+            first = today
 
-        if not include:
-            return False
+        slider = self.historySlider
+        atEnd = slider.value() == slider.maximum()
+
+        slider.setRange(first, today)
 
-        exclude = self.excludeFilter.matches(rp)
+        if atEnd:
+            slider.setValue(today)
+
+    # history slider has been moved
+    def historyMoved(self):
+        self.historyLabel.setText(util.Date.fromOrdinal(
+                self.historySlider.value()).toQDate().toString("d MMM yyyy"))
+
+        if self.historyCb.isChecked():
+            self.updateRouteFilter()
+
+    def updateRouteFilter(self):
+        CW.updateRouteFilter()
 
-        return include and not exclude
+        self.mode.moveEvent()
+        self.w.invalidateStatic()
+        self.w.update()
 
     # transform physical coordinates to logical coordinates, returning the
     # new (x, y) pair
@@ -356,6 +897,21 @@ class Main:
 
         return (x, y)
 
+    # transform logical QRectF to physical QRect, rounding outwards
+    def log2physRect(self, rect):
+        s = self.viewportScale
+        voffs = self.viewportOffset
+
+        return QRectF((rect.x() + voffs.x) * s, (rect.y() + voffs.y) * s,
+                      rect.width() * s, rect.height() * s).toAlignedRect()
+
+    # transform physical QRect to logical QRectF
+    def phys2logRect(self, rect):
+        x, y = self.phys2log(rect.x(), rect.y())
+
+        return QRectF(x, y, rect.width() / self.viewportScale,
+                      rect.height() / self.viewportScale)
+
     # calculate logical mouse pos from physical mouse pos
     def calcMousePos(self):
         self.mousePos = Point(*self.phys2log(
@@ -443,10 +999,15 @@ class Mode:
     def moveEvent(self, x, y):
         raise "abstract method called"
 
-    # paint
+    # paint mode-specific things on top of the walls and routes
     def paint(self, pnt):
         raise "abstract method called"
 
+    # return list of QRectFs, in logical coordinates, covering everything
+    # paint() currently draws
+    def overlayRects(self):
+        return []
+
 class WallMoveMode(Mode):
     def __init__(self):
         Mode.__init__(self, True)
@@ -464,21 +1025,37 @@ class WallMoveMode(Mode):
             self.closestPt = getClosestEndPoint()
 
         if M.mouseDown and self.closestPt:
+            M.w.addDirty(self.neighbourhoodRect())
+
             self.closestPt.x = M.mousePos.x
             self.closestPt.y = M.mousePos.y
 
-            # TODO: optimize this, we only need to recalc the routes
-            # belonging to the two wall segments touching the modified
-            # point
-            for route in CW.routes:
-                route.recalcPos()
+            CW.walls.pointMoved(self.closestPt)
+
+            # only the routes on the two wall segments touching the
+            # modified point move
+            CW.recalcRoutes([w for w in self.closestPt.getWalls() if w])
+
+            M.w.addDirty(self.neighbourhoodRect())
+
+    # return QRectF covering the wall segments touching closestPt and
+    # everything drawn for them
+    def neighbourhoodRect(self):
+        points = [self.closestPt]
+
+        for wall in self.closestPt.getWalls():
+            if wall:
+                points.extend((wall.p1, wall.p2))
+
+        return pointsRect(points, PAINT_MARGIN)
 
     def paint(self, pnt):
         if self.closestPt:
             gutil.drawEllipse(pnt, self.closestPt,
                               CIRCLE_SIZE / M.viewportScale)
 
-        CW.paintRoutes(pnt)
+    def overlayRects(self):
+        return circleRects(self.closestPt)
 
 
 class WallCombineMode(Mode):
@@ -504,17 +1081,20 @@ class WallCombineMode(Mode):
             r2 = l2 / totalLen
 
             w1.p2 = w2.p2
+            CW.walls.wallMoved(w1)
 
             for route in w1.getRoutes():
                 newT = route.t * r1
-                route.attachTo(w1, newT)
+                route.attachTo(w1, newT, False)
 
             for route in w2.getRoutes():
                 newT = route.t * r2 + r1
-                route.attachTo(w1, newT)
+                route.attachTo(w1, newT, False)
+
+            CW.recalcRoutes([w1])
 
-            CW.walls.points.remove(pt)
-            CW.walls.walls.remove(w2)
+            CW.walls.removePoint(pt)
+            CW.walls.removeWall(w2)
 
             self.closestPt = getClosestEndPoint()
 
@@ -526,7 +1106,8 @@ class WallCombineMode(Mode):
             gutil.drawEllipse(pnt, self.closestPt,
                               CIRCLE_SIZE / M.viewportScale)
 
-        CW.paintRoutes(pnt)
+    def overlayRects(self):
+        return circleRects(self.closestPt)
 
 
 class WallAddMode(Mode):
@@ -548,8 +1129,8 @@ class WallAddMode(Mode):
                 ptIdx = len(CW.walls.points)
                 wallIdx = len(CW.walls.walls)
 
-            CW.walls.points.insert(ptIdx, pt)
-            CW.walls.walls.insert(wallIdx, wall)
+            CW.walls.insertPoint(ptIdx, pt)
+            CW.walls.insertWall(wallIdx, wall)
 
             self.closestPt = None
 
@@ -572,7 +1153,11 @@ class WallAddMode(Mode):
             if M.showWallLengthsCb.isChecked():
                 drawDistance(pnt, self.closestPt, M.mousePos)
 
-        CW.paintRoutes(pnt)
+    def overlayRects(self):
+        if not self.closestPt:
+            return []
+
+        return [pointsRect([self.closestPt, M.mousePos], PAINT_MARGIN)]
 
 
 class WallSplitMode(Mode):
@@ -597,17 +1182,20 @@ class WallSplitMode(Mode):
             for route in wOld.getRoutes():
                 if route.t < self.closestT:
                     newT = route.t * tNew
-                    route.attachTo(wNew, newT)
+                    route.attachTo(wNew, newT, False)
                 else:
                     newT = (route.t - self.closestT) * tOld
-                    route.attachTo(wOld, newT)
+                    route.attachTo(wOld, newT, False)
+
+            CW.recalcRoutes([wNew, wOld])
 
             ptIdx = CW.walls.points.index(wOld.p2)
-            CW.walls.points.insert(ptIdx, pt)
+            CW.walls.insertPoint(ptIdx, pt)
+            CW.walls.wallMoved(wOld)
 
             wallIdx = CW.walls.walls.index(wOld)
 
-            CW.walls.walls.insert(wallIdx, wNew)
+            CW.walls.insertWall(wallIdx, wNew)
 
             self.closestPt = None
             self.closestWall = None
@@ -632,7 +1220,8 @@ class WallSplitMode(Mode):
             gutil.drawEllipse(pnt, self.closestPt,
                               CIRCLE_SIZE / M.viewportScale)
 
-        CW.paintRoutes(pnt)
+    def overlayRects(self):
+        return circleRects(self.closestPt)
 
 
 class RouteAddMode(Mode):
@@ -645,8 +1234,9 @@ class RouteAddMode(Mode):
     def buttonEvent(self, isPress):
         if isPress:
             editRoute(M.route)
-            CW.routes.append(M.route)
-            CW.updateRouteFilter()
+            CW.addRoute(M.route)
+            CW.routeEdited(M.route)
+            M.updateHistoryRange()
             M.route = Route()
             self.moveEvent()
 
@@ -662,10 +1252,15 @@ class RouteAddMode(Mode):
             gutil.drawEllipse(pnt, self.closestPt,
                               CIRCLE_SIZE / M.viewportScale)
 
-        CW.paintRoutes(pnt)
-
         M.route.paint(pnt)
 
+    def overlayRects(self):
+        if not self.closestPt:
+            return []
+
+        return (circleRects(self.closestPt) +
+                [pointsRect([M.route], PAINT_MARGIN)])
+
 
 class RouteEditMode(Mode):
     def __init__(self):
@@ -689,7 +1284,8 @@ class RouteEditMode(Mode):
             gutil.drawEllipse(pnt, Point(r.x, r.y),
                               CIRCLE_SIZE / M.viewportScale)
 
-        CW.paintRoutes(pnt)
+    def overlayRects(self):
+        return circleRects(self.closestRoute)
 
 
 class RouteMoveMode(Mode):
@@ -710,7 +1306,9 @@ class RouteMoveMode(Mode):
             closestPt, closestWall, closestT = getClosestPoint()
 
             if closestT:
+                M.w.addDirty(pointsRect([self.route], PAINT_MARGIN))
                 self.route.attachTo(closestWall, closestT)
+                M.w.addDirty(pointsRect([self.route], PAINT_MARGIN))
 
     def paint(self, pnt):
         if self.route:
@@ -718,7 +1316,8 @@ class RouteMoveMode(Mode):
             gutil.drawEllipse(pnt, Point(r.x, r.y),
                               CIRCLE_SIZE / M.viewportScale)
 
-        CW.paintRoutes(pnt)
+    def overlayRects(self):
+        return circleRects(self.route)
 
 
 class ProfileEditMode(Mode):
@@ -743,7 +1342,8 @@ class ProfileEditMode(Mode):
             gutil.drawEllipse(pnt, Point(r.x, r.y),
                               CIRCLE_SIZE / M.viewportScale)
 
-        CW.paintRoutes(pnt)
+    def overlayRects(self):
+        return circleRects(self.closestRoute)
 
 
 # a single continuous climbing wall, consisting of wall segments and
@@ -752,38 +1352,441 @@ class ClimbingWall:
     # file-format version that we write out
     VERSION = 1
 
+    # start of binary format files
+    BINARY_MAGIC = "CWBW"
+
     def __init__(self):
-        # all routes
+        # all routes. if loaded from a snapshot, routes not created yet are
+        # None, see getRoute.
         self.routes = []
 
-        # active routes (i.e. not filtered out of current view)
-        self.activeRoutes = []
+        # key = route, value = its sequence number, which is the same as
+        # its index in 'routes'
+        self.routeSeq = {}
+
+        # key = route id, value = Route
+        self.routesById = {}
+
+        # WallSnapshot that routes not created yet come from, or None
+        self.snapshot = None
+
+        # routes that have been modified since journalWritten was last
+        # called
+        self.dirtyRoutes = set()
+
+        # bitmap indexes of routes' attributes
+        self.attrIndex = RouteAttrIndex()
+
+        # sorted sequence numbers of active routes (i.e. not filtered out
+        # of current view)
+        self.activeSeqs = []
+
+        # bitset (see RouteAttrIndex) of activeSeqs
+        self.activeBits = 0
+
+        # spatial index of active routes' positions, the items being their
+        # sequence numbers
+        self.routeIndex = spatial.Grid(ROUTE_GRID_SIZE)
+
+        # RouteFilter used for activeSeqs, or None if updateRouteFilter
+        # has not been called yet
+        self.routeFilter = None
 
         self.walls = Walls.createInitial()
         self.id = util.UUID()
 
-    # update activeRoutes based on current filter settings
+    # return binary format representation. this stores the same
+    # information as toXml, but is a lot faster to load.
+    def toBinary(self):
+        self.createAllRoutes()
+
+        w = binio.Writer()
+
+        w.writeHeader(ClimbingWall.BINARY_MAGIC, self.__class__.VERSION)
+        w.writeUUID(self.id)
+
+        points = self.walls.points
+        walls = self.walls.walls
+
+        w.writeUInt32(len(points))
+        w.writeArray("d", [p.x / SCALE for p in points])
+        w.writeArray("d", [p.y / SCALE for p in points])
+
+        w.writeUInt32(len(walls))
+        w.writeUUIDs([wall.id for wall in walls])
+
+        wallCodes = dict((wall, i) for i, wall in enumerate(walls))
+        colorCodes = dict((c, i) for i, c in enumerate(COLORS))
+        markerCodes = dict((m, i) for i, m in enumerate(Marker.MARKERS))
+
+        routes = self.routes
+
+        w.writeUInt32(len(routes))
+        w.writeUUIDs([r.id for r in routes])
+        w.writeArray("I", [wallCodes[r.wall] for r in routes])
+        w.writeArray("d", [r.t for r in routes])
+        w.writeArray("B", [colorCodes[r.color] for r in routes])
+        w.writeArray("B", [markerCodes[r.marker] for r in routes])
+        w.writeArray("B", [r.rating.compareIdx for r in routes])
+        w.writeArray("i", [dateCode(r.dateAdded) for r in routes])
+        w.writeArray("i", [dateCode(r.dateRemoved) for r in routes])
+
+        return w.getData()
+
+    # load from data created by toBinary. updateRouteFilter must be called
+    # afterwards.
+    @staticmethod
+    def loadBinary(data):
+        cw = ClimbingWall.fromSnapshot(WallSnapshot(data))
+        cw.createAllRoutes()
+
+        return cw
+
+    # create from a WallSnapshot, without creating any Route objects.
+    # updateRouteFilter must be called afterwards.
+    @staticmethod
+    def fromSnapshot(snapshot):
+        cw = ClimbingWall()
+        cw.id = snapshot.id
+        cw.setLoadedWalls(snapshot.walls)
+
+        cw.snapshot = snapshot
+        cw.routes = [None] * snapshot.count
+        cw.rebuildAttrIndex()
+
+        return cw
+
+    # open snapshot file 'filename' (see writeSnapshot) by memory-mapping
+    # it. the file must not be modified while the returned ClimbingWall
+    # is in use; writeSnapshot replaces it with a new file instead.
+    # updateRouteFilter must be called afterwards.
+    @staticmethod
+    def openSnapshot(filename):
+        return ClimbingWall.fromSnapshot(WallSnapshot(mapFile(filename)))
+
+    # write binary format snapshot of ourselves to 'filename'. the file is
+    # replaced atomically, so a ClimbingWall still using the old file is
+    # not affected. throws EnvironmentError on errors.
+    def writeSnapshot(self, filename):
+        util.writeFileAtomic(filename, self.toBinary())
+
+    # check and load attributes of root element of a saved file
+    def loadRootAttrs(self, root):
+        ClimbingWall.checkVersion(root)
+
+        self.id = util.getUUIDAttr(root, "id")
+
+    # check and return version of root element of a saved file
+    @staticmethod
+    def checkVersion(root):
+        version = util.str2int(util.getAttr(root, "version"), 0)
+
+        util.cfgAssert(version > 0, "Invalid version attribute")
+
+        util.cfgAssert(version <= ClimbingWall.VERSION,
+                       "File uses a newer format than this program recognizes."
+                       " Please upgrade your program.")
+
+        return version
+
+    # set walls being loaded as our walls, returning dictionary of them
+    # with key = wall id, value = Wall
+    def setLoadedWalls(self, walls):
+        walls.finishLoad()
+        self.walls = walls
+
+        return walls.wallsById
+
+    # update activeSeqs based on current filter settings
     def updateRouteFilter(self):
-        del self.activeRoutes[:]
+        self.routeFilter = RouteFilter()
+
+        bits = self.routeFilter.bits(self.attrIndex)
+        changed = bits ^ self.activeBits
+        self.activeBits = bits
 
-        showDeleted = M.showDeletedCb.isChecked()
+        self.activeSeqs = RouteAttrIndex.seqs(bits)
 
-        if not showDeleted:
-            now = util.Date.now()
+        # only routes whose state changed need updating in the spatial
+        # index
+        added = []
+
+        for seq in RouteAttrIndex.seqs(changed):
+            if seq in self.routeIndex:
+                self.routeIndex.remove(seq)
+            else:
+                added.append(seq)
+
+        self.routeIndex.addPoints((seq,) + self.getRoutePos(seq)
+                                  for seq in added)
+
+    # rebuild bitmap indexes of routes' attributes from scratch
+    def rebuildAttrIndex(self):
+        if self.snapshot:
+            cwProf = M.profile.getWallProfile(self.id)
+
+            if cwProf:
+                keys = self.snapshot.getKeys(cwProf.routeProfiles)
+            else:
+                keys = self.snapshot.getKeys({})
         else:
-            now = None
+            keys = [None] * len(self.routes)
 
-        for route in self.routes:
-            if (route.rating.isActive() and
-                M.routeInProfileFilter(self.id, route.id) and
-                (showDeleted or route.existedAt(now))):
-                self.activeRoutes.append(route)
+        for seq, route in enumerate(self.routes):
+            if route:
+                keys[seq] = RouteAttrIndex.makeKey(
+                    route, self.getRouteProfile(route))
 
-    def paintRoutes(self, pnt):
-        for route in self.activeRoutes:
-            route.paint(pnt)
+        self.attrIndex.load(keys)
+
+    # return the RouteAttrIndex key of route with given sequence number,
+    # without creating the Route if it doesn't exist yet
+    def getRouteKey(self, seq):
+        route = self.routes[seq]
+
+        if route:
+            return RouteAttrIndex.makeKey(route, self.getRouteProfile(route))
+
+        return self.snapshot.getKey(
+            seq, self.getRouteProfileById(self.snapshot.ids[seq]))
+
+    # return (x, y) position of route with given sequence number, without
+    # creating the Route if it doesn't exist yet
+    def getRoutePos(self, seq):
+        route = self.routes[seq]
+
+        if route:
+            return (route.x, route.y)
+
+        return self.snapshot.getPos(seq)
+
+    # return route with given sequence number, creating it from the
+    # snapshot if needed
+    def getRoute(self, seq):
+        route = self.routes[seq]
+
+        if route is None:
+            self.snapshot.takeRoute(seq)
+            route = self.createRoute(seq)
+            route.recalcPos()
+
+        return route
+
+    # create route with given sequence number from the snapshot. the
+    # caller is responsible for calling recalcPos (or recalcRoutes)
+    # afterwards.
+    def createRoute(self, seq):
+        route = self.snapshot.createRoute(seq)
+
+        self.routes[seq] = route
+        self.routeSeq[route] = seq
+        self.routesById[route.id] = route
+
+        return route
+
+    # create all routes on given wall segments that don't exist yet. must
+    # be called before accessing the wall segments' routes directly.
+    def createWallRoutes(self, walls):
+        if self.snapshot and self.snapshot.hasRoutes(walls):
+            self.recalcRoutes(walls)
+
+    # return rough estimate of how much memory we use, in bytes. routes
+    # not created yet from a snapshot use less memory than those that have
+    # been.
+    def memoryUsage(self):
+        return (len(self.walls.walls) * WALL_MEMORY +
+                len(self.routes) * ROUTE_MEMORY +
+                len(self.routeSeq) * ROUTE_OBJECT_MEMORY)
+
+    # create all routes that don't exist yet, and forget the snapshot
+    def createAllRoutes(self):
+        if self.snapshot:
+            self.recalcRoutes(self.snapshot.getWalls())
+            self.snapshot = None
+
+    # lookup route by id. returns None if not found.
+    def getRouteById(self, routeId):
+        seq = self.getRouteSeq(routeId)
+
+        if seq is None:
+            return None
+
+        return self.getRoute(seq)
+
+    # return sequence number of route with given id, or None if not found
+    def getRouteSeq(self, routeId):
+        route = self.routesById.get(routeId)
+
+        if route:
+            return self.routeSeq[route]
+
+        if self.snapshot:
+            return self.snapshot.seqById.get(routeId)
+
+        return None
+
+    # must be called after the climbing profile has been replaced, with
+    # oldProfile being the previous one. updates attrIndex for the routes
+    # that have a RouteProfile in either of them. updateRouteFilter must
+    # be called afterwards.
+    def profileReplaced(self, oldProfile):
+        routeIds = set()
+
+        for prof in (oldProfile, M.profile):
+            cwProf = prof.getWallProfile(self.id)
+
+            if cwProf:
+                routeIds.update(cwProf.routeProfiles)
+
+        for routeId in routeIds:
+            seq = self.getRouteSeq(routeId)
+
+            if seq is not None:
+                self.attrIndex.set(seq, self.getRouteKey(seq))
+
+    # return RouteProfile for given route, or None
+    def getRouteProfile(self, route):
+        return self.getRouteProfileById(route.id)
+
+    # return RouteProfile for route with given id, or None
+    def getRouteProfileById(self, routeId):
+        return M.profile.getRouteProfile(self.id, routeId, False)
+
+    # add new route
+    def addRoute(self, route):
+        seq = len(self.routes)
+
+        self.routes.append(route)
+        self.routeSeq[route] = seq
+        self.routesById[route.id] = route
+
+        self.routeChanged(route)
+
+    # must be called after anything affecting whether a route passes the
+    # route filter (rating, color, marker, dates, profile) has been
+    # changed. updates attrIndex and adds/removes the route to/from
+    # activeSeqs as needed, without going through the other routes.
+    def routeChanged(self, route):
+        seq = self.routeSeq.get(route)
+
+        # not one of ours (e.g. a route still being added)
+        if seq is None:
+            return
+
+        key = self.getRouteKey(seq)
+        self.attrIndex.set(seq, key)
+
+        # filter not set up yet
+        if not self.routeFilter:
+            return
+
+        isActive = seq in self.routeIndex
+        shouldBeActive = self.routeFilter.matchesKey(key)
+
+        if isActive == shouldBeActive:
+            return
+
+        self.activeBits ^= 1 << seq
+
+        i = bisect.bisect_left(self.activeSeqs, seq)
+
+        if shouldBeActive:
+            self.activeSeqs.insert(i, seq)
+            self.routeIndex.add(seq, route.x, route.y)
+        else:
+            del self.activeSeqs[i]
+            self.routeIndex.remove(seq)
+
+    # must be called after anything stored in route's XML (attributes,
+    # wall, position on wall) has changed, so it gets journaled
+    def routeEdited(self, route):
+        if route in self.routeSeq:
+            self.dirtyRoutes.add(route)
+
+    # must be called after route's position has changed
+    def routeMoved(self, route):
+        seq = self.routeSeq.get(route)
+
+        if (seq is not None) and (seq in self.routeIndex):
+            self.routeIndex.update(seq, route.x, route.y)
+
+    # paint active routes at given level of detail (DETAIL_*). if rect
+    # (QRectF, logical coordinates) is given, routes that can't be visible
+    # inside it are skipped.
+    def paintRoutes(self, pnt, rect = None, detail = DETAIL_FULL):
+        seqs = self.activeSeqs
+
+        if rect:
+            visible = self.routeIndex.query(
+                *rectCoords(rect, PAINT_MARGIN))
+
+            # routes must always be painted in the same order, otherwise
+            # partial repaints of overlapping routes would not match
+            # what a full repaint looks like
+            if len(visible) != len(seqs):
+                seqs = sorted(visible)
+
+        routes = [self.getRoute(seq) for seq in seqs]
+
+        if detail == DETAIL_FULL:
+            Route.paintList(pnt, routes)
+        else:
+            Route.paintSimple(pnt, routes, detail == DETAIL_DOTS)
+
+    # recalculate positions of all routes on given wall segments (all of
+    # them if None). this does the same as calling Route.recalcPos for each
+    # route, but if NumPy is available, does the calculations for all the
+    # routes in one go.
+    def recalcRoutes(self, walls = None):
+        if walls is None:
+            walls = self.walls.walls
+
+        if self.snapshot:
+            for seq in self.snapshot.takeRoutes(walls):
+                self.createRoute(seq)
+
+        routes = []
+
+        # index into 'walls' for each route
+        wallIdx = []
+
+        for i, wall in enumerate(walls):
+            routes.extend(wall.routes)
+            wallIdx.extend([i] * len(wall.routes))
+
+        if not routes:
+            return
+
+        if numpy is None:
+            for route in routes:
+                route.recalcPos()
+
+            return
+
+        p1x = numpy.array([w.p1.x for w in walls])
+        p1y = numpy.array([w.p1.y for w in walls])
+        abx = numpy.array([w.p2.x for w in walls]) - p1x
+        aby = numpy.array([w.p2.y for w in walls]) - p1y
+
+        # all routes on a wall segment have the same angle, see
+        # Route.recalcPos
+        angles = 90.0 - numpy.where(
+            abx != 0.0, numpy.degrees(numpy.arctan2(-aby, abx)) % 180.0,
+            90.0)
+
+        idx = numpy.array(wallIdx)
+        t = numpy.fromiter((r.t for r in routes), float, len(routes))
+
+        xs = p1x[idx] + abx[idx] * t
+        ys = p1y[idx] + aby[idx] * t
+
+        for route, x, y, angle in zip(routes, xs.tolist(), ys.tolist(),
+                                      angles[idx].tolist()):
+            route.setPos(x, y, angle)
+
+    def toXml(self):
+        self.createAllRoutes()
 
-    def save(self):
         el = etree.Element("ClimbingWall")
         el.set("version", str(self.__class__.VERSION))
         el.set("id", self.id)
@@ -795,42 +1798,584 @@ class ClimbingWall:
         for route in sorted(self.routes, key = operator.attrgetter("id")):
             routesEl.append(route.toXml())
 
-        data = etree.tostring(el, xml_declaration = True,
-                              encoding = "UTF-8", pretty_print = True)
+        return el
+
+    # return work for util.SaveThread that saves us in full to CW_FILE
+    # and CW_SNAPSHOT_FILE. the XML tree is built here, but serializing
+    # it, which is most of the work, is left to the thread. the binary
+    # format is fast enough to create here.
+    def getSaveWork(self):
+        el = self.toXml()
+        data = self.toBinary()
+
+        return [(CW_FILE, lambda: toXmlData(el)),
+                (CW_SNAPSHOT_FILE, lambda: data)]
+
+    # return list of journal entries (see applyJournal) for the changes
+    # made since journalWritten was last called
+    def getJournalEntries(self):
+        entries = []
+
+        if self.walls.dirty:
+            el = etree.Element("Geometry")
+            self.walls.save(el)
+            entries.append(el)
+
+        for route in sorted(self.dirtyRoutes, key = self.routeSeq.get):
+            entries.append(route.toXml())
+
+        return entries
+
+    # must be called after the entries returned by getJournalEntries have
+    # been written
+    def journalWritten(self):
+        self.walls.dirty = False
+        self.dirtyRoutes.clear()
+
+    # apply entries read from a journal written using getJournalEntries.
+    # must be called right after loading, before updateRouteFilter.
+    def applyJournal(self, entries):
+        # the last version of the wall geometry, if any
+        geometryEl = None
+
+        # key = route id, value = last version of the route
+        routeEls = {}
+
+        # route ids, in the order they were first seen, so that new routes
+        # get the same sequence numbers they had when the entries were
+        # written
+        routeIds = []
+
+        for el in entries:
+            if el.tag == "Geometry":
+                geometryEl = el
+            elif el.tag == "Route":
+                routeId = util.getUUIDAttr(el, "id")
+
+                if routeId not in routeEls:
+                    routeIds.append(routeId)
+
+                routeEls[routeId] = el
+            else:
+                util.cfgAssert(0, "Unknown journal entry '%s'" % el.tag)
+
+        if geometryEl is not None:
+            # all routes need attaching to the new walls
+            self.createAllRoutes()
+
+            wallsById = self.setLoadedWalls(Walls.load(geometryEl))
+
+            for route in self.routes:
+                if route.id not in routeEls:
+                    wall = wallsById.get(route.wall.id)
+
+                    util.cfgAssert(wall, "Route attached to unknown wall '%s'"
+                                   % route.wall.id)
+
+                    route.attachTo(wall, route.t, False)
+        else:
+            wallsById = self.walls.wallsById
+
+        for routeId in routeIds:
+            route = Route.load(routeEls[routeId], wallsById)
+            seq = self.getRouteSeq(routeId)
+
+            if seq is None:
+                self.addRoute(route)
+            else:
+                oldRoute = self.getRoute(seq)
+                oldRoute.wall.routes.remove(oldRoute)
+                del self.routeSeq[oldRoute]
 
-        util.writeToFile("pump2.xml", data, M.mw)
+                self.routes[seq] = route
+                self.routeSeq[route] = seq
+                self.routesById[routeId] = route
 
+                self.attrIndex.set(seq, self.getRouteKey(seq))
+
+            if geometryEl is None:
+                route.recalcPos()
+
+        if geometryEl is not None:
+            self.recalcRoutes()
+
+        # all of the above is already in the journal
+        self.journalWritten()
+
+    # load from source, which is either a filename or a file object, in
+    # XML format. updateRouteFilter must be called afterwards. the
+    # file is parsed incrementally, with elements being thrown away once
+    # they've been handled, so memory use does not depend on the size of
+    # the file. Points must come before Walls, and Walls before Routes,
+    # as save() writes them.
     @staticmethod
-    def load(data):
+    def load(source):
+        cw = ClimbingWall()
+        walls = Walls()
+
+        # key = wall id, value = Wall. None until all walls have been
+        # loaded.
+        wallsById = None
+
+        for tags, el in iterWallElements(source):
+            if not tags:
+                cw.loadRootAttrs(el)
+            elif tags == ("Points", "Point"):
+                walls.points.append(Point.load(el))
+            elif tags == ("Walls", "Wall"):
+                walls.walls.append(Wall.load(el, walls))
+            elif tags == ("Routes", "Route"):
+                if wallsById is None:
+                    wallsById = cw.setLoadedWalls(walls)
+
+                route = Route.load(el, wallsById)
+
+                util.cfgAssert(not cw.getRouteById(route.id),
+                               "Duplicate route id '%s'" % route.id)
+
+                cw.addRoute(route)
+
+        if wallsById is None:
+            cw.setLoadedWalls(walls)
+
+        cw.recalcRoutes()
+
+        return cw
+
+
+# read-only view of a climbing wall in binary format (see
+# ClimbingWall.toBinary), from which a ClimbingWall creates its Route
+# objects only when they're needed. the route arrays are used in place,
+# without copying them, if NumPy is available. data is a string or an
+# mmap object.
+class WallSnapshot:
+    def __init__(self, data):
+        r = binio.Reader(data)
+
+        r.readHeader(ClimbingWall.BINARY_MAGIC, ClimbingWall.VERSION)
+
+        self.id = r.readUUID()
+
+        walls = Walls()
+
+        count = r.readUInt32()
+        xs = r.readArrayView("d", count).tolist()
+        ys = r.readArrayView("d", count).tolist()
+
+        walls.points = [Point(x * SCALE, y * SCALE) for x, y in zip(xs, ys)]
+
+        count = r.readUInt32()
+
+        util.cfgAssert(count == (len(walls.points) - 1),
+                       "Invalid number of points or walls")
+
+        for i, wallId in enumerate(r.readUUIDs(count)):
+            walls.walls.append(
+                Wall(walls.points[i], walls.points[i + 1], wallId))
+
+        self.walls = walls
+
+        # walls in file order, which is what wallCodes refers to. the
+        # Walls object's list changes when walls are added or removed.
+        self.wallList = list(walls.walls)
+
+        count = r.readUInt32()
+
+        self.count = count
+        self.ids = r.readUUIDs(count)
+        self.wallCodes = r.readArrayView("I", count)
+        self.ts = r.readArrayView("d", count)
+        self.colorCodes = r.readArrayView("B", count)
+        self.markerCodes = r.readArrayView("B", count)
+        self.ratingCodes = r.readArrayView("B", count)
+        self.added = r.readArrayView("i", count)
+        self.removed = r.readArrayView("i", count)
+
+        util.cfgAssert(r.atEnd(), "Extra data at end of file")
+
+        wallCodes = self.wallCodes.tolist()
+
+        util.cfgAssert(not wallCodes or (max(wallCodes) < len(walls.walls)),
+                       "Route attached to unknown wall")
+        util.cfgAssert(not count or (max(self.colorCodes) < len(COLORS)),
+                       "Unknown color")
+        util.cfgAssert(not count or
+                       (max(self.markerCodes) < len(Marker.MARKERS)),
+                       "Unknown marker shape")
+        util.cfgAssert(not count or
+                       (max(self.ratingCodes) < len(Rating.RATINGS)),
+                       "Unknown rating")
+
+        # key = date ordinal, value = util.Date, so routes share Date
+        # objects
+        self.dates = {0 : None}
+
+        for ordinal in set(self.added.tolist() + self.removed.tolist()):
+            if ordinal not in self.dates:
+                self.dates[ordinal] = util.Date.loadOrdinal(ordinal)
+
+        # key = route id, value = sequence number
+        self.seqById = {}
+
+        for seq, routeId in enumerate(self.ids):
+            util.cfgAssert(self.seqById.setdefault(routeId, seq) == seq,
+                           "Duplicate route id '%s'" % routeId)
+
+        # key = Wall, value = list of sequence numbers of routes on it
+        # that have not been created yet
+        self.pending = {}
+
+        for seq, code in enumerate(wallCodes):
+            self.pending.setdefault(self.wallList[code], []).append(seq)
+
+        # routes' positions, calculated the same way as Route.recalcPos
+        # does
+        px = [p.x for p in walls.points]
+        py = [p.y for p in walls.points]
+
+        if numpy is None:
+            ts = self.ts.tolist()
+
+            self.xs = [px[w] + (px[w + 1] - px[w]) * t
+                       for w, t in zip(wallCodes, ts)]
+            self.ys = [py[w] + (py[w + 1] - py[w]) * t
+                       for w, t in zip(wallCodes, ts)]
+        else:
+            px = numpy.array(px)
+            py = numpy.array(py)
+            w = numpy.asarray(self.wallCodes, int)
+
+            self.xs = (px[w] + (px[w + 1] - px[w]) * self.ts).tolist()
+            self.ys = (py[w] + (py[w + 1] - py[w]) * self.ts).tolist()
+
+    # return (x, y) position of route with given sequence number
+    def getPos(self, seq):
+        return (self.xs[seq], self.ys[seq])
+
+    # return RouteAttrIndex key of route with given sequence number, rp
+    # being its RouteProfile or None
+    def getKey(self, seq, rp):
+        if rp:
+            flags = rp.flags()
+        else:
+            flags = 0
+
+        return (Rating.RATINGS[self.ratingCodes[seq]],
+                COLORS[self.colorCodes[seq]],
+                Marker.MARKERS[self.markerCodes[seq]],
+                flags,
+                int(self.added[seq]) or None,
+                int(self.removed[seq]) or None)
+
+    # return list of RouteAttrIndex keys of all routes, routeProfiles
+    # being a dictionary of their RouteProfiles with key = route id. this
+    # is the same as calling getKey for each route, but a lot faster.
+    def getKeys(self, routeProfiles):
+        ratings = [Rating.RATINGS[c] for c in self.ratingCodes.tolist()]
+        colors = [COLORS[c] for c in self.colorCodes.tolist()]
+        markers = [Marker.MARKERS[c] for c in self.markerCodes.tolist()]
+
+        flags = [0] * self.count
+
+        for routeId, rp in routeProfiles.iteritems():
+            seq = self.seqById.get(routeId)
+
+            if seq is not None:
+                flags[seq] = rp.flags()
+
+        added = [ordinal or None for ordinal in self.added.tolist()]
+        removed = [ordinal or None for ordinal in self.removed.tolist()]
+
+        return zip(ratings, colors, markers, flags, added, removed)
+
+    # create Route with given sequence number, attached to its wall but
+    # without calculating its position
+    def createRoute(self, seq):
+        route = Route(self.ids[seq])
+        route.color = COLORS[self.colorCodes[seq]]
+        route.marker = Marker.MARKERS[self.markerCodes[seq]]
+        route.rating = Rating.RATINGS[self.ratingCodes[seq]]
+        route.dateAdded = self.dates[self.added[seq]]
+        route.dateRemoved = self.dates[self.removed[seq]]
+
+        route.attachTo(self.wallList[self.wallCodes[seq]],
+                       float(self.ts[seq]), False)
+
+        return route
+
+    # return True if any of given walls has routes not created yet
+    def hasRoutes(self, walls):
+        for wall in walls:
+            if wall in self.pending:
+                return True
+
+        return False
+
+    # return list of walls having routes not created yet
+    def getWalls(self):
+        return self.pending.keys()
+
+    # return sequence numbers of the routes on given walls that have not
+    # been created yet, and forget about them. the caller must create
+    # them.
+    def takeRoutes(self, walls):
+        ret = []
+
+        for wall in walls:
+            ret.extend(self.pending.pop(wall, []))
+
+        return ret
+
+    # forget about the route with given sequence number, which must not
+    # have been created yet. the caller must create it.
+    def takeRoute(self, seq):
+        wall = self.wallList[self.wallCodes[seq]]
+        seqs = self.pending[wall]
+        seqs.remove(seq)
+
+        if not seqs:
+            del self.pending[wall]
+
+
+# summary of a climbing wall file, read without loading the whole file,
+# see Workspace. XML format files may have a binary format snapshot and a
+# journal next to them, named like Main.loadCW uses them (see
+# getSidecarFilename). the summary is as of the last full save, so it
+# does not include changes in the journal.
+class WallInfo:
+    def __init__(self, filename):
+        self.filename = filename
+
+        self.id = None
+        self.version = 0
+
+        # QRectF covering the wall's points, in logical coordinates
+        self.bounds = QRectF()
+
+        self.routeCount = 0
+
+    # return True if 'filename' is in XML format
+    def isXml(self):
+        return self.filename.lower().endswith(XML_EXT)
+
+    # return WallInfo of given file. throws EnvironmentError or
+    # error.ConfigError on errors.
+    @staticmethod
+    def read(filename):
+        info = WallInfo(filename)
+
+        if not info.isXml():
+            info.readBinary(mapFile(filename))
+
+            return info
+
+        snapshotFilename = getSidecarFilename(filename, SNAPSHOT_EXT)
+
+        # only the header of a binary file needs reading, while an XML file
+        # has to be read to the end to count the routes
         try:
-            root = etree.XML(data)
-            cw = ClimbingWall()
+            if (os.path.getmtime(snapshotFilename) >=
+                os.path.getmtime(filename)):
+                info.readBinary(mapFile(snapshotFilename))
 
-            version = util.str2int(util.getAttr(root, "version"), 0)
+                return info
 
-            util.cfgAssert(version > 0, "Invalid version attribute")
+        except (EnvironmentError, error.ConfigError):
+            pass
 
-            util.cfgAssert(version <= cw.__class__.VERSION,
-                           "File uses a newer format than this program recognizes."
-                           " Please upgrade your program.")
+        info.readXml()
 
-            cw.id = util.getUUIDAttr(root, "id")
+        return info
 
-            cw.walls = Walls.load(root)
+    # read from binary format data (see ClimbingWall.toBinary), only
+    # looking at as much of it as is needed
+    def readBinary(self, data):
+        r = binio.Reader(data)
 
-            for el in root.xpath("Routes/Route"):
-                cw.routes.append(Route.load(el, cw))
+        self.version = r.readHeader(ClimbingWall.BINARY_MAGIC,
+                                    ClimbingWall.VERSION)
+        self.id = r.readUUID()
 
-            cw.updateRouteFilter()
+        count = r.readUInt32()
+        xs = r.readArrayView("d", count).tolist()
+        ys = r.readArrayView("d", count).tolist()
 
-            return cw
+        if count:
+            self.bounds = pointsRect(
+                [Point(x * SCALE, y * SCALE) for x, y in zip(xs, ys)])
 
-        except etree.XMLSyntaxError, e:
-            util.cfgAssert(0, "XML parsing error: %s" % e)
+        r.skip(r.readUInt32() * 16)
+
+        self.routeCount = r.readUInt32()
+
+    # read from 'filename' in XML format, incrementally like
+    # ClimbingWall.load, but without creating any walls or routes
+    def readXml(self):
+        points = []
+
+        for tags, el in iterWallElements(self.filename):
+            if not tags:
+                util.cfgAssert(el.tag == "ClimbingWall",
+                               "Not a climbing wall file")
+
+                self.version = ClimbingWall.checkVersion(el)
+                self.id = util.getUUIDAttr(el, "id")
+            elif tags == ("Points", "Point"):
+                points.append(Point.load(el))
+            elif tags == ("Routes", "Route"):
+                self.routeCount += 1
+
+        if points:
+            self.bounds = pointsRect(points)
+
+    # load the whole wall, from the snapshot if it's up to date, and apply
+    # its journal. updateRouteFilter must be called afterwards. throws
+    # EnvironmentError or error.ConfigError on errors.
+    def open(self):
+        if not self.isXml():
+            return ClimbingWall.openSnapshot(self.filename)
+
+        cw = openFreshSnapshot(
+            self.filename, getSidecarFilename(self.filename, SNAPSHOT_EXT))
+
+        if cw is None:
+            cw = ClimbingWall.load(self.filename)
+
+        cw.applyJournal(journal.Journal(
+                getSidecarFilename(self.filename, JOURNAL_EXT)).read())
+
+        return cw
+
+# catalog of many climbing wall files, indexed by wall id. only the
+# summary of each file (see WallInfo) is read when it's added; the walls
+# themselves are loaded when they are opened, and recently used ones are
+# kept in memory as long as their estimated memory use (see
+# ClimbingWall.memoryUsage) fits in the memory budget.
+class Workspace:
+    def __init__(self, memoryBudget = WORKSPACE_MEMORY_BUDGET):
+        # in bytes. the most recently opened wall is kept in memory even if
+        # it alone does not fit in the budget.
+        self.memoryBudget = memoryBudget
+
+        # key = wall id, value = WallInfo
+        self.infos = {}
+
+        # key = wall id, value = ClimbingWall, least recently used first
+        self.cache = collections.OrderedDict()
+
+    # add file to catalog, returning its WallInfo. throws EnvironmentError
+    # or error.ConfigError on errors.
+    def addFile(self, filename):
+        info = WallInfo.read(filename)
+
+        other = self.infos.get(info.id)
+
+        util.cfgAssert(not other or (other.filename == filename),
+                       "Wall '%s' is in both '%s' and '%s'" % (
+                info.id, other and other.filename, filename))
+
+        self.infos[info.id] = info
+        self.cache.pop(info.id, None)
+
+        return info
+
+    # add all climbing wall files in given directory: XML format files, and
+    # binary format ones that aren't just snapshots of XML format files.
+    # returns list of (filename, error message) tuples for files that could
+    # not be added. throws EnvironmentError if the directory can't be read.
+    def addDir(self, dirname):
+        errors = []
+
+        names = sorted(os.listdir(dirname))
+        lowerNames = set([name.lower() for name in names])
+
+        for name in names:
+            lower = name.lower()
+
+            if lower.endswith(SNAPSHOT_EXT):
+                if getSidecarFilename(lower, XML_EXT) in lowerNames:
+                    continue
+            elif not lower.endswith(XML_EXT):
+                continue
+
+            filename = os.path.join(dirname, name)
+
+            try:
+                self.addFile(filename)
+
+            except EnvironmentError, e:
+                errors.append((filename, e.strerror))
+
+            except error.ConfigError, e:
+                errors.append((filename, str(e)))
+
+        return errors
+
+    # return WallInfo of given wall, or None if not found
+    def getInfo(self, wallId):
+        return self.infos.get(wallId)
+
+    # return WallInfos of all walls, ordered by filename
+    def getInfos(self):
+        return sorted(self.infos.values(),
+                      key = operator.attrgetter("filename"))
+
+    # return ClimbingWall with given id, loading it if it's not in memory
+    # already. updateRouteFilter must be called on walls that were not in
+    # memory. throws EnvironmentError or error.ConfigError on errors.
+    def open(self, wallId):
+        info = self.infos.get(wallId)
+
+        util.cfgAssert(info, "Unknown wall '%s'" % wallId)
+
+        cw = self.cache.pop(wallId, None)
+
+        if cw is None:
+            cw = info.open()
+
+            util.cfgAssert(cw.id == wallId,
+                           "File '%s' has changed" % info.filename)
+
+        self.cache[wallId] = cw
+        self.evict()
+
+        return cw
+
+    # return True if given wall is in memory
+    def isOpen(self, wallId):
+        return wallId in self.cache
+
+    # forget about given wall being in memory
+    def close(self, wallId):
+        self.cache.pop(wallId, None)
+
+    # return estimated memory use of walls in memory, in bytes
+    def memoryUsage(self):
+        return sum([cw.memoryUsage() for cw in self.cache.itervalues()])
+
+    # forget least recently used walls until the rest fit in the memory
+    # budget. walls can use more memory the longer they're used, as routes
+    # get created from their snapshots, so this is also worth calling
+    # every now and then.
+    def evict(self):
+        while (len(self.cache) > 1) and (self.memoryUsage() >
+                                         self.memoryBudget):
+            self.cache.popitem(False)
 
 
 # profile of when/how one person has climbed a specific route
 class RouteProfile:
+    # bit flags returned by flags()
+    TOPROPED = 1
+    TOPROPED_FALL = 2
+    LEAD_CLIMBED = 4
+    LEAD_CLIMBED_FALL = 8
+
+    FLAGS = (TOPROPED, TOPROPED_FALL, LEAD_CLIMBED, LEAD_CLIMBED_FALL)
+
+    # names of the date attributes
+    DATES = ("toproped", "topropedFall", "leadClimbed", "leadClimbedFall")
+
     def __init__(self, routeId):
         self.routeId = routeId
 
@@ -848,6 +2393,25 @@ class RouteProfile:
         # lead-climbed with falls
         self.leadClimbedFall = None
 
+    # return bitwise or of the flags for the ways the route has been
+    # climbed
+    def flags(self):
+        ret = 0
+
+        if self.toproped:
+            ret |= RouteProfile.TOPROPED
+
+        if self.topropedFall:
+            ret |= RouteProfile.TOPROPED_FALL
+
+        if self.leadClimbed:
+            ret |= RouteProfile.LEAD_CLIMBED
+
+        if self.leadClimbedFall:
+            ret |= RouteProfile.LEAD_CLIMBED_FALL
+
+        return ret
+
     # returns True if profile should be saved (profiles with no dates set
     # should not be saved because they contain no information)
     def shouldBeSaved(self):
@@ -930,6 +2494,9 @@ class ClimbingProfile:
     # file-format version that we write out
     VERSION = 1
 
+    # start of binary format files
+    BINARY_MAGIC = "CWBP"
+
     def __init__(self):
         # name of person
         self.name = "Anonymous"
@@ -937,7 +2504,16 @@ class ClimbingProfile:
         # key = ClimbingWall id, value = ClimbingWallProfile
         self.cwProfiles = {}
 
-    def save(self):
+        # ClimbingWall sections of the file we were loaded from that have
+        # not been turned into ClimbingWallProfiles yet, see getWallProfile.
+        # key = ClimbingWall id, value = lxml Element.
+        self.unloaded = {}
+
+        # (wallId, routeId) tuples of RouteProfiles that have been modified
+        # since journalWritten was last called
+        self.dirty = set()
+
+    def toXml(self):
         el = etree.Element("Profile")
 
         el.set("version", str(self.__class__.VERSION))
@@ -948,19 +2524,68 @@ class ClimbingProfile:
         for cwProf in self.cwProfiles.itervalues():
             cwsEl.append(cwProf.toXml())
 
-        data = etree.tostring(el, xml_declaration = True,
-                              encoding = "UTF-8", pretty_print = True)
+        # sections that have not been loaded can't have changed, so they're
+        # written back as they were. they're copied because appending them
+        # as such would move them out of wherever they are now.
+        for cwEl in self.unloaded.itervalues():
+            cwsEl.append(copy.deepcopy(cwEl))
+
+        return el
 
-        # FIXME: can't use fixed filename
-        util.writeToFile("osku.xml", data, M.mw)
+    # return work for util.SaveThread that saves us in full to
+    # PROFILE_FILE, see ClimbingWall.getSaveWork
+    def getSaveWork(self):
+        el = self.toXml()
 
-        # FIXME: debug stuff, remove
-        print "saved profile osku.xml"
+        return [(PROFILE_FILE, lambda: toXmlData(el))]
+
+    # must be called after the RouteProfile of given route on given wall
+    # has been modified, so it gets journaled
+    def routeProfileEdited(self, wallId, routeId):
+        self.dirty.add((wallId, routeId))
+
+    # return list of journal entries (see applyJournal) for the changes
+    # made since journalWritten was last called
+    def getJournalEntries(self):
+        entries = []
+
+        for wallId, routeId in sorted(self.dirty):
+            el = etree.Element("ClimbingWall")
+            el.set("wallId", wallId)
+            el.append(self.getRouteProfile(wallId, routeId).toXml())
+            entries.append(el)
+
+        return entries
+
+    # must be called after the entries returned by getJournalEntries have
+    # been written
+    def journalWritten(self):
+        self.dirty.clear()
+
+    # apply entries read from a journal written using getJournalEntries
+    def applyJournal(self, entries):
+        for el in entries:
+            util.cfgAssert(el.tag == "ClimbingWall",
+                           "Unknown journal entry '%s'" % el.tag)
 
+            entryProf = ClimbingWallProfile.load(el)
+            cwProf = self.getWallProfile(entryProf.wallId)
+
+            if cwProf:
+                cwProf.routeProfiles.update(entryProf.routeProfiles)
+            else:
+                self.cwProfiles[entryProf.wallId] = entryProf
+
+    # load from XML format data. the ClimbingWall sections are only
+    # indexed by their wall id here, and turned into ClimbingWallProfiles
+    # when they're first needed, see getWallProfile.
     @staticmethod
     def load(data):
         try:
-            root = etree.XML(data)
+            # the unloaded sections are written back as they are, so
+            # whitespace must not be kept, or pretty-printing the output
+            # wouldn't work
+            root = etree.XML(data, etree.XMLParser(remove_blank_text = True))
             cp = ClimbingProfile()
 
             version = util.str2int(util.getAttr(root, "version"), 0)
@@ -974,8 +2599,7 @@ class ClimbingProfile:
             cp.name = util.getAttr(root, "name")
 
             for el in root.xpath("ClimbingWalls/ClimbingWall"):
-                cwProf = ClimbingWallProfile.load(el)
-                cp.cwProfiles[cwProf.wallId] = cwProf
+                cp.unloaded[util.getUUIDAttr(el, "wallId")] = el
 
             return cp
 
@@ -983,26 +2607,452 @@ class ClimbingProfile:
             util.cfgAssert(0, "XML parsing error: %s" % e)
 
 
-    def getRouteProfile(self, wallId, routeId, add = False):
+    # return binary format representation. this stores the same
+    # information as toXml, but is a lot faster to load.
+    def toBinary(self):
+        w = binio.Writer()
+
+        w.writeHeader(ClimbingProfile.BINARY_MAGIC, self.__class__.VERSION)
+        w.writeString(self.name)
+
+        cwProfs = self.getWallProfiles()
+
+        w.writeUInt32(len(cwProfs))
+
+        for cwProf in cwProfs:
+            rps = [rp for rp in cwProf.routeProfiles.itervalues()
+                   if rp.shouldBeSaved()]
+
+            w.writeUUID(cwProf.wallId)
+            w.writeUInt32(len(rps))
+            w.writeUUIDs([rp.routeId for rp in rps])
+
+            for name in RouteProfile.DATES:
+                w.writeArray("i", [dateCode(getattr(rp, name)) for rp in rps])
+
+        return w.getData()
+
+    # load from data created by toBinary
+    @staticmethod
+    def loadBinary(data):
+        r = binio.Reader(data)
+
+        r.readHeader(ClimbingProfile.BINARY_MAGIC, ClimbingProfile.VERSION)
+
+        cp = ClimbingProfile()
+        cp.name = r.readString()
+
+        # key = date ordinal, value = util.Date, so profiles share Date
+        # objects
+        dates = {0 : None}
+
+        for i in xrange(r.readUInt32()):
+            cwProf = ClimbingWallProfile(r.readUUID())
+
+            count = r.readUInt32()
+            rps = [RouteProfile(routeId) for routeId in r.readUUIDs(count)]
+
+            for name in RouteProfile.DATES:
+                for rp, ordinal in zip(rps, r.readArray("i", count)):
+                    date = dates.get(ordinal)
+
+                    if (date is None) and ordinal:
+                        date = util.Date.loadOrdinal(ordinal)
+                        dates[ordinal] = date
+
+                    setattr(rp, name, date)
+
+            for rp in rps:
+                cwProf.routeProfiles[rp.routeId] = rp
+
+            cp.cwProfiles[cwProf.wallId] = cwProf
+
+        util.cfgAssert(r.atEnd(), "Extra data at end of file")
+
+        return cp
+
+    # return ClimbingWallProfile for given wall, loading it from its
+    # section of the file we were loaded from if that hasn't been done yet.
+    # if there is none, returns None, or if add is True, adds an empty one.
+    # throws error.ConfigError if the section is invalid, in which case it
+    # is left unloaded.
+    def getWallProfile(self, wallId, add = False):
         cwProf = self.cwProfiles.get(wallId)
 
-        if not cwProf:
-            if not add:
-                return None
+        if cwProf:
+            return cwProf
+
+        el = self.unloaded.get(wallId)
 
+        if el is not None:
+            cwProf = ClimbingWallProfile.load(el)
+            del self.unloaded[wallId]
+        elif add:
             cwProf = ClimbingWallProfile(wallId)
-            self.cwProfiles[wallId] = cwProf
+        else:
+            return None
+
+        self.cwProfiles[wallId] = cwProf
+
+        return cwProf
+
+    # return list of all ClimbingWallProfiles, loading those not loaded
+    # yet. throws error.ConfigError if any of them is invalid.
+    def getWallProfiles(self):
+        for wallId in self.unloaded.keys():
+            self.getWallProfile(wallId)
+
+        return self.cwProfiles.values()
+
+    def getRouteProfile(self, wallId, routeId, add = False):
+        cwProf = self.getWallProfile(wallId, add)
+
+        if not cwProf:
+            return None
 
         return cwProf.getRouteProfile(routeId, add)
 
     def editProfile(self, wallId, route):
         rp = self.getRouteProfile(wallId, route.id, True)
 
-        dlg = ProfileEditDlg(rp)
+        dlg = ProfileEditDlg(route, rp)
 
         with CursorShower():
             dlg.exec_()
 
+# climbing profiles of many people, stored in an SQLite database with one
+# row per ascent, so that questions such as who has climbed a route can be
+# answered without loading every profile. profiles are identified by their
+# names. methods throw sqlite3.Error on database errors.
+class ProfileStore:
+    # database schema version that we create
+    VERSION = 1
+
+    SCHEMA = """
+        CREATE TABLE profiles (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE);
+
+        -- one row per RouteProfile date that is set. type is the
+        -- RouteProfile flag of the date, date is its ordinal.
+        CREATE TABLE ascents (
+            profileId INTEGER NOT NULL REFERENCES profiles (id),
+            wallId TEXT NOT NULL,
+            routeId TEXT NOT NULL,
+            type INTEGER NOT NULL,
+            date INTEGER NOT NULL,
+            PRIMARY KEY (profileId, wallId, routeId, type));
+
+        CREATE INDEX ascentsByRoute ON ascents (wallId, routeId, type);
+        CREATE INDEX ascentsByType ON ascents (type, date);
+        CREATE INDEX ascentsByDate ON ascents (profileId, date);
+        """
+
+    # open or create database file 'filename'. throws error.ConfigError if
+    # it's not a profile store this program can use.
+    def __init__(self, filename):
+        self.db = sqlite3.connect(filename)
+
+        try:
+            version = self.db.execute("PRAGMA user_version").fetchone()[0]
+
+            util.cfgAssert(version <= ProfileStore.VERSION,
+                           "File uses a newer format than this program"
+                           " recognizes. Please upgrade your program.")
+
+            if version == 0:
+                with self.db:
+                    self.db.executescript(ProfileStore.SCHEMA)
+                    self.db.execute("PRAGMA user_version = %d" %
+                                    ProfileStore.VERSION)
+
+        except sqlite3.DatabaseError, e:
+            self.db.close()
+            util.cfgAssert(0, "Database error: %s" % e)
+
+        except error.ConfigError:
+            self.db.close()
+            raise
+
+    def close(self):
+        self.db.close()
+
+    # return sorted list of names of all profiles
+    def getNames(self):
+        return [name for (name,) in self.db.execute(
+                "SELECT name FROM profiles ORDER BY name")]
+
+    # return id of profile with given name, or None if not found
+    def getProfileId(self, name):
+        row = self.db.execute("SELECT id FROM profiles WHERE name = ?",
+                              (name,)).fetchone()
+
+        return row and row[0]
+
+    # store ClimbingProfile, replacing any earlier version of it
+    def saveProfile(self, cp):
+        with self.db:
+            profileId = self.getProfileId(cp.name)
+
+            if profileId is None:
+                profileId = self.db.execute(
+                    "INSERT INTO profiles (name) VALUES (?)",
+                    (cp.name,)).lastrowid
+            else:
+                self.db.execute("DELETE FROM ascents WHERE profileId = ?",
+                                (profileId,))
+
+            self.db.executemany(
+                "INSERT INTO ascents VALUES (?, ?, ?, ?, ?)",
+                ((profileId, cwProf.wallId, routeId, flag, ordinal)
+                 for cwProf in cp.getWallProfiles()
+                 for routeId, rp in cwProf.routeProfiles.iteritems()
+                 for flag, ordinal in ProfileStore.getAscentRows(rp)))
+
+    # store the RouteProfile of a single route in given profile, which
+    # must exist, replacing any earlier version of it
+    def saveRouteProfile(self, name, wallId, rp):
+        with self.db:
+            profileId = self.getProfileId(name)
+
+            util.cfgAssert(profileId is not None,
+                           "Unknown profile '%s'" % name)
+
+            self.db.execute("DELETE FROM ascents WHERE profileId = ? AND"
+                            " wallId = ? AND routeId = ?",
+                            (profileId, wallId, rp.routeId))
+
+            self.db.executemany(
+                "INSERT INTO ascents VALUES (?, ?, ?, ?, ?)",
+                ((profileId, wallId, rp.routeId, flag, ordinal)
+                 for flag, ordinal in ProfileStore.getAscentRows(rp)))
+
+    # return list of (type, date ordinal) tuples of the dates set in given
+    # RouteProfile
+    @staticmethod
+    def getAscentRows(rp):
+        ret = []
+
+        for flag, name in zip(RouteProfile.FLAGS, RouteProfile.DATES):
+            date = getattr(rp, name)
+
+            if date:
+                ret.append((flag, date.toOrdinal()))
+
+        return ret
+
+    # return ClimbingProfile with given name. if wallIds is given, only
+    # the parts of the profile for those walls are loaded. throws
+    # error.ConfigError if there's no such profile, or if it has invalid
+    # dates.
+    def loadProfile(self, name, wallIds = None):
+        profileId = self.getProfileId(name)
+
+        util.cfgAssert(profileId is not None, "Unknown profile '%s'" % name)
+
+        cp = ClimbingProfile()
+        cp.name = name
+
+        if wallIds is None:
+            rows = self.db.execute(
+                "SELECT wallId, routeId, type, date FROM ascents"
+                " WHERE profileId = ?", (profileId,))
+        else:
+            rows = itertools.chain(*[self.db.execute(
+                        "SELECT wallId, routeId, type, date FROM ascents"
+                        " WHERE profileId = ? AND wallId = ?",
+                        (profileId, wallId)) for wallId in wallIds])
+
+        # key = date ordinal, value = util.Date, so profiles share Date
+        # objects
+        dates = {}
+
+        # key = type, value = name of the RouteProfile attribute
+        attrs = dict(zip(RouteProfile.FLAGS, RouteProfile.DATES))
+
+        for wallId, routeId, flag, ordinal in rows:
+            util.cfgAssert(flag in attrs, "Unknown ascent type %d" % flag)
+            date = dates.get(ordinal)
+
+            if date is None:
+                date = util.Date.loadOrdinal(ordinal)
+                dates[ordinal] = date
+
+            rp = cp.getRouteProfile(str(wallId), str(routeId), True)
+            setattr(rp, attrs[flag], date)
+
+        return cp
+
+    # remove profile with given name. does nothing if there is no such
+    # profile.
+    def removeProfile(self, name):
+        with self.db:
+            profileId = self.getProfileId(name)
+
+            if profileId is not None:
+                self.db.execute("DELETE FROM ascents WHERE profileId = ?",
+                                (profileId,))
+                self.db.execute("DELETE FROM profiles WHERE id = ?",
+                                (profileId,))
+
+    # return list of (profile name, type, util.Date) tuples of ascents of
+    # given route whose type has a bit of mask (RouteProfile flags) set,
+    # ordered by date. for example, who has lead-climbed a route can be
+    # found using mask = LEAD_CLIMBED | LEAD_CLIMBED_FALL.
+    def getRouteAscents(self, wallId, routeId, mask):
+        flags = [flag for flag in RouteProfile.FLAGS if flag & mask]
+
+        rows = self.db.execute(
+            "SELECT profiles.name, ascents.type, ascents.date"
+            " FROM ascents JOIN profiles ON profiles.id = ascents.profileId"
+            " WHERE ascents.wallId = ? AND ascents.routeId = ? AND"
+            " ascents.type IN (%s) ORDER BY ascents.date, profiles.name" %
+            ", ".join(["?"] * len(flags)), [wallId, routeId] + flags)
+
+        return [(name, flag, util.Date.loadOrdinal(ordinal))
+                for name, flag, ordinal in rows]
+
+    # return list of (wall id, route id, type, util.Date) tuples of given
+    # profile's ascents whose type has a bit of mask (RouteProfile flags)
+    # set, done between util.Dates start and end (start inclusive, end
+    # exclusive, None meaning no limit), ordered by date
+    def getAscents(self, name, mask, start = None, end = None):
+        flags = [flag for flag in RouteProfile.FLAGS if flag & mask]
+
+        rows = self.db.execute(
+            "SELECT ascents.wallId, ascents.routeId, ascents.type,"
+            " ascents.date FROM ascents"
+            " JOIN profiles ON profiles.id = ascents.profileId"
+            " WHERE profiles.name = ? AND ascents.date >= ? AND"
+            " ascents.date < ? AND ascents.type IN (%s)"
+            " ORDER BY ascents.date, ascents.wallId, ascents.routeId" %
+            ", ".join(["?"] * len(flags)),
+            [name, start and start.toOrdinal() or 0,
+             end and end.toOrdinal() or sys.maxint] + flags)
+
+        return [(str(wallId), str(routeId), flag,
+                 util.Date.loadOrdinal(ordinal))
+                for wallId, routeId, flag, ordinal in rows]
+
+
+# return contents of an XML file having given root element
+def toXmlData(el):
+    return etree.tostring(el, xml_declaration = True, encoding = "UTF-8",
+                          pretty_print = True)
+
+# parse the climbing wall XML in source (a filename or a file object)
+# incrementally. yields (tags, el) pairs: ((), root) when the root element
+# starts, and then every element below it once it has ended, tags being
+# the element tags from below the root down to el. elements at most two
+# levels below the root are thrown away after they've been handled, the
+# ones deeper down only together with their parents, so they're still
+# there when the parent is handled. throws error.ConfigError on syntax
+# errors.
+def iterWallElements(source):
+    # tags of the elements from the root down to the current one
+    path = []
+
+    try:
+        for event, el in etree.iterparse(source, events = ("start", "end")):
+            if event == "start":
+                path.append(el.tag)
+
+                if len(path) == 1:
+                    yield (), el
+
+                continue
+
+            tags = tuple(path[1:])
+            path.pop()
+
+            if not tags:
+                continue
+
+            yield tags, el
+
+            if len(tags) <= 2:
+                el.clear()
+
+                while el.getprevious() is not None:
+                    del el.getparent()[0]
+
+    except etree.XMLSyntaxError, e:
+        util.cfgAssert(0, "XML parsing error: %s" % e)
+
+# return contents of given file memory-mapped for reading. throws
+# EnvironmentError or error.ConfigError on errors.
+def mapFile(filename):
+    f = open(filename, "rb")
+
+    try:
+        # an empty file can't be memory-mapped
+        util.cfgAssert(os.fstat(f.fileno()).st_size > 0, "Empty file")
+
+        return mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+    finally:
+        f.close()
+
+# return ClimbingWall opened from snapshotFilename, or None if it does not
+# exist, is older than filename, or can't be used for some other reason.
+# the snapshot is only a cache of filename, which should then be loaded
+# instead.
+def openFreshSnapshot(filename, snapshotFilename):
+    try:
+        if os.path.getmtime(snapshotFilename) < os.path.getmtime(filename):
+            return None
+
+        return ClimbingWall.openSnapshot(snapshotFilename)
+
+    except (EnvironmentError, error.ConfigError):
+        return None
+
+# return name of the file next to given one having the same name but
+# given extension
+def getSidecarFilename(filename, ext):
+    return os.path.splitext(filename)[0] + ext
+
+# return date ordinal of given util.Date, or 0 if it is None. used in
+# binary formats.
+def dateCode(date):
+    if date:
+        return date.toOrdinal()
+    else:
+        return 0
+
+# return QRectF, in logical coordinates, that covers all given points
+# (Points, Routes, or anything else with x and y), grown by margin on all
+# sides
+def pointsRect(points, margin = 0.0):
+    xs = [pt.x for pt in points]
+    ys = [pt.y for pt in points]
+
+    x1 = min(xs) - margin
+    y1 = min(ys) - margin
+
+    return QRectF(x1, y1, max(xs) + margin - x1, max(ys) + margin - y1)
+
+# return level of detail (DETAIL_*) to use for current viewport scale
+def getDetailLevel():
+    if M.viewportScale < DETAIL_DOTS_SCALE:
+        return DETAIL_DOTS
+    elif M.viewportScale < DETAIL_SIMPLE_SCALE:
+        return DETAIL_SIMPLE
+    else:
+        return DETAIL_FULL
+
+# return (x1, y1, x2, y2) coordinates of given QRectF grown by margin on
+# all sides
+def rectCoords(rect, margin = 0.0):
+    return (rect.left() - margin, rect.top() - margin,
+            rect.right() + margin, rect.bottom() + margin)
+
+# return list containing the QRectF covered by a marker circle drawn with
+# gutil.drawEllipse around pt, or an empty list if pt is None
+def circleRects(pt):
+    if not pt:
+        return []
+
+    return [pointsRect([pt], CIRCLE_SIZE / M.viewportScale)]
 
 # draw distance between two points
 def drawDistance(pnt, p1, p2):
@@ -1010,14 +3060,18 @@ def drawDistance(pnt, p1, p2):
 
     dst = p1.distanceTo(p2)
 
-    pnt.setFont(WALL_FONT)
+    pnt.setFont(gutil.getFont(*WALL_FONT)[0])
     pnt.drawText(QPointF((p1.x + p2.x) / 2.0,
                          (p1.y + p2.y) / 2.0),
                  "%.2f m" % (dst / SCALE))
 
     pnt.restore()
 
-class Point:
+# Point, Wall and Route objects exist in large numbers, so they use
+# __slots__ instead of a per-instance dict to keep memory use down.
+class Point(object):
+    __slots__ = ("x", "y")
+
     def __init__(self, x, y):
         self.x = float(x)
         self.y = float(y)
@@ -1044,19 +3098,7 @@ class Point:
     # return walls around this point as a (Wall, Wall) tuple. if point is
     # start/end point, either one may be None.
     def getWalls(self):
-        w1 = None
-        w2 = None
-
-        for wall in CW.walls.walls:
-            if wall.p2 is self:
-                w1 = wall
-            elif wall.p1 is self:
-                w2 = wall
-
-            if w2:
-                break
-
-        return (w1, w2)
+        return tuple(CW.walls.adjacent.get(self, (None, None)))
 
     def toXml(self):
         el = etree.Element("Point")
@@ -1083,11 +3125,17 @@ class Point:
 # http://local.wasp.uwa.edu.au/~pbourke/geometry/pointline/
 # http://www.gamedev.net/community/forums/topic.asp?topic_id=444154&whichpage=1&#2941160
 def closestPoint(A, B, P):
-    AP = P - A
-    AB = B - A
+    t = closestT(A, B, P)
+
+    return (Point(A.x + (B.x - A.x) * t, A.y + (B.y - A.y) * t), t)
 
-    ab2 = AB.x * AB.x + AB.y * AB.y
-    ap_ab = AP.x * AB.x + AP.y * AB.y
+# return just the second value of closestPoint().
+def closestT(A, B, P):
+    abx = B.x - A.x
+    aby = B.y - A.y
+
+    ab2 = abx * abx + aby * aby
+    ap_ab = (P.x - A.x) * abx + (P.y - A.y) * aby
 
     # FIXME: check ab2 != 0.0
     t = ap_ab / ab2
@@ -1097,60 +3145,56 @@ def closestPoint(A, B, P):
     elif t < 0.0:
         t = 0.0
 
-    closest = A + AB * t
+    return t
+
+# return distance from P to the closest point on line segment (A, B)
+def segmentDistance(A, B, P):
+    t = closestT(A, B, P)
 
-    return (closest, t)
+    return math.hypot(A.x + (B.x - A.x) * t - P.x,
+                      A.y + (B.y - A.y) * t - P.y)
 
 # return (Point, Wall, t) tuple of closest point on the wall to mouse
 # cursor. t is same as second value returned from closestPoint().
 def getClosestPoint():
-    closestDistance = 99999999.9
-    closestPt = None
-    closestT = None
-    closestWall = None
+    mp = M.mousePos
 
-    for wall in CW.walls.walls:
-        closest, t = closestPoint(wall.p1, wall.p2, M.mousePos)
+    closestWall, dst = CW.walls.wallIndex.closest(
+        mp.x, mp.y, lambda wall: segmentDistance(wall.p1, wall.p2, mp))
 
-        dst = closest.distanceTo(M.mousePos)
+    if not closestWall:
+        return (None, None, None)
 
-        if dst < closestDistance:
-            closestDistance = dst
-            closestPt = closest
-            closestT = t
-            closestWall = wall
+    closestPt, t = closestPoint(closestWall.p1, closestWall.p2, mp)
 
-    return (closestPt, closestWall, closestT)
+    return (closestPt, closestWall, t)
 
 # return closest wall end point to mouse cursor, or None if it does not
 # exist
 def getClosestEndPoint():
-    closestDistance = 99999999.9
-    closestPt = None
-
-    for pt in CW.walls.points:
-        dst = pt.distanceTo(M.mousePos)
-
-        if dst < closestDistance:
-            closestDistance = dst
-            closestPt = pt
+    mp = M.mousePos
 
-    return closestPt
+    return CW.walls.pointIndex.closest(
+        mp.x, mp.y, lambda pt: pt.distanceTo(mp))[0]
 
 # return closest active route to mouse cursor, or None if it does not
 # exist
 def getClosestRoute():
-    closestDistance = 99999999.9
-    closestRoute = None
+    x = M.mousePos.x
+    y = M.mousePos.y
 
-    for route in CW.activeRoutes:
-        dst = M.mousePos.distanceTo(Point(route.x, route.y))
+    def distance(seq):
+        rx, ry = CW.getRoutePos(seq)
 
-        if dst < closestDistance:
-            closestDistance = dst
-            closestRoute = route
+        return math.hypot(rx - x, ry - y)
 
-    return closestRoute
+    seq = CW.routeIndex.closest(x, y, distance)[0]
+
+    if seq is None:
+        return None
+
+    # only the route being hit-tested needs to exist as a Route object
+    return CW.getRoute(seq)
 
 class RouteEditDlg(QtGui.QDialog):
     def __init__(self, route):
@@ -1208,13 +3252,20 @@ class RouteEditDlg(QtGui.QDialog):
         self.route.dateAdded = self.dateAddedW.date
         self.route.dateRemoved = self.dateRemovedW.date
 
+        self.route.changed()
+        CW.routeEdited(self.route)
+        CW.routeChanged(self.route)
+        M.updateHistoryRange()
+
+        M.w.invalidateStatic()
         M.w.update()
 
 class ProfileEditDlg(QtGui.QDialog):
-    def __init__(self, rp):
+    def __init__(self, route, rp):
         QtGui.QDialog.__init__(self, M.mw)
 
-        # RouteProfile
+        # Route being edited, and its RouteProfile
+        self.route = route
         self.rp = rp
 
         self.setWindowTitle("Edit profile")
@@ -1248,7 +3299,12 @@ class ProfileEditDlg(QtGui.QDialog):
         self.rp.leadClimbed = self.leadClimbedW.date
         self.rp.leadClimbedFall = self.leadClimbedFallW.date
 
-        M.updateRouteFilter()
+        M.profile.routeProfileEdited(CW.id, self.rp.routeId)
+        CW.routeChanged(self.route)
+
+        M.mode.moveEvent()
+        M.w.invalidateStatic()
+        M.w.update()
 
 # to be used for enabling cursor over main window when showing a modal
 # dialog (because the main window doesn't get mouse move events in that
@@ -1271,11 +3327,14 @@ def editRoute(route):
     with CursorShower():
         dlg.exec_()
 
-class Wall:
-    def __init__(self, p1, p2):
+class Wall(object):
+    __slots__ = ("p1", "p2", "id", "routes")
+
+    # if wallId is None, a new one is generated
+    def __init__(self, p1, p2, wallId = None):
         self.p1 = p1
         self.p2 = p2
-        self.id = util.UUID()
+        self.id = wallId or util.UUID()
 
         self.routes = []
 
@@ -1284,6 +3343,9 @@ class Wall:
 
     # return a copy of the wall's routes
     def getRoutes(self):
+        if CW:
+            CW.createWallRoutes([self])
+
         return list(self.routes)
 
     def toXml(self):
@@ -1295,9 +3357,7 @@ class Wall:
 
     @staticmethod
     def load(el, walls):
-        w = Wall(None, None)
-
-        w.id = util.getUUIDAttr(el, "id")
+        w = Wall(None, None, util.getUUIDAttr(el, "id"))
 
         # use the next pair of points
         index = len(walls.walls)
@@ -1315,6 +3375,26 @@ class Walls:
         self.points = []
         self.walls = []
 
+        # spatial indexes of points and wall segments. these must be kept
+        # up to date whenever the above lists or point coordinates are
+        # modified, so don't modify them directly but use the methods
+        # below.
+        self.pointIndex = spatial.Grid(GRID_SIZE)
+        self.wallIndex = spatial.Grid(GRID_SIZE)
+
+        # key = Point, value = [wall ending at point, wall starting at
+        # point], either of which may be None. kept up to date the same
+        # way as the spatial indexes.
+        self.adjacent = {}
+
+        # key = wall id, value = Wall. kept up to date the same way as the
+        # spatial indexes.
+        self.wallsById = {}
+
+        # True if points or walls have been added, removed or moved since
+        # ClimbingWall.journalWritten was last called
+        self.dirty = False
+
         self.pen = QPen(QtCore.Qt.black)
         self.pen.setWidthF(5.0)
 
@@ -1342,22 +3422,101 @@ class Walls:
         for i in xrange(1, len(w.points)):
             w.walls.append(Wall(w.points[i - 1], w.points[i]))
 
+        w.rebuildIndex()
+
         return w
 
+    # rebuild spatial indexes, point adjacency information and id lookup
+    # table from scratch
+    def rebuildIndex(self):
+        self.pointIndex.clear()
+        self.wallIndex.clear()
+        self.adjacent.clear()
+        self.wallsById.clear()
+
+        for pt in self.points:
+            self.pointIndex.add(pt, pt.x, pt.y)
+            self.adjacent[pt] = [None, None]
+
+        for wall in self.walls:
+            self.wallsById[wall.id] = wall
+            self.wallMoved(wall)
+
+    def insertPoint(self, index, pt):
+        self.dirty = True
+        self.points.insert(index, pt)
+        self.pointIndex.add(pt, pt.x, pt.y)
+        self.adjacent[pt] = [None, None]
+
+    def removePoint(self, pt):
+        self.dirty = True
+        self.points.remove(pt)
+        self.pointIndex.remove(pt)
+        del self.adjacent[pt]
+
+    def insertWall(self, index, wall):
+        self.dirty = True
+        self.walls.insert(index, wall)
+        self.wallsById[wall.id] = wall
+        self.wallMoved(wall)
+
+    def removeWall(self, wall):
+        self.dirty = True
+        self.walls.remove(wall)
+        self.wallIndex.remove(wall)
+        del self.wallsById[wall.id]
+
+        # the end points may already have been attached to other walls
+        adj = self.adjacent.get(wall.p1)
+
+        if adj and (adj[1] is wall):
+            adj[1] = None
+
+        adj = self.adjacent.get(wall.p2)
+
+        if adj and (adj[0] is wall):
+            adj[0] = None
+
+    # must be called after given point's coordinates have been changed
+    def pointMoved(self, pt):
+        self.dirty = True
+        self.pointIndex.add(pt, pt.x, pt.y)
+
+        for wall in pt.getWalls():
+            if wall:
+                self.wallMoved(wall)
+
+    # must be called after given wall's end points have been changed, or
+    # the end points themselves have moved
+    def wallMoved(self, wall):
+        self.wallIndex.addSegment(wall, wall.p1.x, wall.p1.y,
+                                  wall.p2.x, wall.p2.y)
+
+        self.adjacent[wall.p1][1] = wall
+        self.adjacent[wall.p2][0] = wall
+
     # lookup wall segment by id. returns None if not found.
     def getWallById(self, wallId):
-        for w in self.walls:
-            if w.id == wallId:
-                return w
-
-        return None
+        return self.wallsById.get(wallId)
 
-    def paint(self, pnt, drawEndPoints):
+    # paint walls at given level of detail (DETAIL_*). if rect (QRectF,
+    # logical coordinates) is given, walls that can't be visible inside it
+    # are skipped.
+    def paint(self, pnt, drawEndPoints, rect = None, detail = DETAIL_FULL):
         pnt.setPen(self.pen)
 
-        showWallLen = M.showWallLengthsCb.isChecked()
+        showWallLen = (M.showWallLengthsCb.isChecked() and
+                       (detail != DETAIL_DOTS))
 
-        for wall in self.walls:
+        walls = self.walls
+        points = self.points
+
+        if rect:
+            walls = self.wallIndex.query(*rectCoords(rect, PAINT_MARGIN))
+            points = self.pointIndex.query(
+                *rectCoords(rect, RECTANGLE_SIZE))
+
+        for wall in walls:
             pnt.drawLine(QLineF(wall.p1.x, wall.p1.y, wall.p2.x, wall.p2.y))
 
             if showWallLen:
@@ -1366,7 +3525,7 @@ class Walls:
         if drawEndPoints:
             offset = RECTANGLE_SIZE / 2.0
 
-            for pt in self.points:
+            for pt in points:
                 pnt.drawRect(QRectF(pt.x - offset, pt.y - offset,
                                     RECTANGLE_SIZE, RECTANGLE_SIZE))
 
@@ -1380,27 +3539,38 @@ class Walls:
         for w in self.walls:
             wallEl.append(w.toXml())
 
+    # load from el, which must contain what save() stores in an element
     @staticmethod
-    def load(root):
-        w = Walls()
+    def load(el):
+        walls = Walls()
 
-        for el in root.xpath("Points/Point"):
-            w.points.append(Point.load(el))
+        for pointEl in el.xpath("Points/Point"):
+            walls.points.append(Point.load(pointEl))
 
-        for el in root.xpath("Walls/Wall"):
-            w.walls.append(Wall.load(el, w))
+        for wallEl in el.xpath("Walls/Wall"):
+            walls.walls.append(Wall.load(wallEl, walls))
 
-        util.cfgAssert(len(w.walls) == (len(w.points) - 1),
+        return walls
+
+    # must be called after all points and walls have been loaded
+    def finishLoad(self):
+        util.cfgAssert(len(self.walls) == (len(self.points) - 1),
                        "Invalid number of points or walls")
 
-        return w
+        self.rebuildIndex()
 
-class Marker:
+        util.cfgAssert(len(self.wallsById) == len(self.walls),
+                       "Duplicate wall ids")
+
+class Marker(object):
     SIZE = 18
 
     # all possible Marker objects
     MARKERS = []
 
+    # key = name, value = Marker
+    BY_NAME = {}
+
     # marker shapes
     SQUARE, RECTANGLE, CROSS, DIAMOND_TAIL = range(4)
 
@@ -1414,6 +3584,12 @@ class Marker:
         self.gridPen = QPen(QtCore.Qt.green)
         self.gridPen.setWidthF(0.2)
 
+        # shape of marker, see createPolygons
+        self.polygons = self.createPolygons()
+
+        # the filter QCheckBox item associated with us
+        self.checkbox = None
+
     def size(self):
         return Marker.SIZE
 
@@ -1422,43 +3598,59 @@ class Marker:
 
     @staticmethod
     def load(s):
-        for marker in Marker.MARKERS:
-            if marker.name == s:
-                return marker
+        marker = Marker.BY_NAME.get(s)
+
+        util.cfgAssert(marker, "Unknown marker shape '%s'" % s)
 
-        util.cfgAssert(0, "Unknown marker shape '%s'" % s)
+        return marker
 
     # marker should fit in a rectangle whose dimensions are Marker.SIZE.
-    # in this paint function, the coordinate system is set up as follows:
+    # the polygons returned are in a coordinate system set up as follows:
     #  x = left side of rectangle
     #  y (implicitly 0) = center of rectangle
+    def getPolygons(self, x):
+        return [poly.translated(x, 0) for poly in self.polygons]
+
+    # paint marker, see getPolygons for the coordinate system
     def paint(self, pnt, color, x):
         pnt.setPen(self.pen)
         pnt.setBrush(color.brush)
 
+        for poly in self.getPolygons(x):
+            pnt.drawPolygon(poly)
+
+        #self.paintGrid(pnt, x, 0)
+
+    # return list of QPolygonFs making up the marker's shape, with x = 0.
+    # see getPolygons.
+    def createPolygons(self):
         size = Marker.SIZE
         mSize = size
 
+        # return rectangle as a polygon, rotated by 'angle' degrees around
+        # (cx, cy)
+        def rect(x, y, w, h, cx = 0.0, cy = 0.0, angle = 0.0):
+            t = QtGui.QTransform()
+            t.translate(cx, cy)
+            t.rotate(angle)
+
+            return t.map(QtGui.QPolygonF(QRectF(x, y, w, h)))
+
         if self.shape == Marker.SQUARE:
-            pnt.drawRect(QRectF(x, -size / 2.0, size, size))
+            return [rect(0, -size / 2.0, size, size)]
 
         elif self.shape == Marker.RECTANGLE:
             size /= 3.0
 
-            pnt.save()
-            pnt.translate(x + mSize / 2.0, 0)
-            pnt.rotate(-45)
-            pnt.drawRect(QRectF(-mSize / 2.0, -size / 2.0, mSize, size))
-            pnt.restore()
+            return [rect(-mSize / 2.0, -size / 2.0, mSize, size,
+                         mSize / 2.0, 0, -45)]
 
         elif self.shape == Marker.CROSS:
             size /= 3.0
-            pnt.drawRect(QRectF(x, -size / 2.0, mSize, size))
 
-            pnt.drawRect(QRectF(
-                    x + mSize / 2.0 - size / 2.0,
-                    -mSize / 2.0,
-                    size, mSize))
+            return [rect(0, -size / 2.0, mSize, size),
+                    rect(mSize / 2.0 - size / 2.0, -mSize / 2.0,
+                         size, mSize)]
 
         elif self.shape == Marker.DIAMOND_TAIL:
             tailSize = size / 3.0
@@ -1467,19 +3659,9 @@ class Marker:
             # half of the diagonal of the diamond square
             a = dSize / SQRT_2
 
-            pnt.drawRect(QRectF(x + tailSize, -size / 2.0 + a,
-                                tailSize, size - a))
-
-            pnt.save()
-            pnt.translate(x + size / 2.0,
-                          -size / 2.0 + a)
-            pnt.rotate(-45)
-            pnt.drawRect(QRectF(-dSize / 2.0, -dSize / 2.0,
-                                 dSize, dSize))
-
-            pnt.restore()
-
-        #self.paintGrid(pnt, x, 0)
+            return [rect(tailSize, -size / 2.0 + a, tailSize, size - a),
+                    rect(-dSize / 2.0, -dSize / 2.0, dSize, dSize,
+                         size / 2.0, -size / 2.0 + a, -45)]
 
     # when debugging paint problems, it's useful to have a grid painted on
     # top of the marker to show boundaries and center lines.
@@ -1512,9 +3694,16 @@ Marker.MARKERS.extend(
      Marker("DiamondTail", Marker.DIAMOND_TAIL)
      ])
 
-class Route:
-    def __init__(self):
-        self.id = util.UUID()
+Marker.BY_NAME.update((m.name, m) for m in Marker.MARKERS)
+
+class Route(object):
+    __slots__ = ("id", "rating", "color", "marker", "dateAdded",
+                 "dateRemoved", "x", "y", "t", "angle", "wall", "offset",
+                 "flipSide", "paintCache")
+
+    # if routeId is None, a new one is generated
+    def __init__(self, routeId = None):
+        self.id = routeId or util.UUID()
         self.rating = Rating.RATINGS[0]
         self.color = COLORS[0]
         self.marker = Marker.MARKERS[0]
@@ -1528,17 +3717,25 @@ class Route:
         self.angle = 0.0
         self.wall = None
 
-        self.font = QtGui.QFont("Courier New Bold", 18)
-        self.font.setPixelSize(18)
-        #self.font = QtGui.QFontDialog.getFont(self.font)[0]
-
-        self.fontMetrics = QtGui.QFontMetrics(self.font)
-
         self.offset = 10
         self.flipSide = False
 
         # FIXME: save/load flipside, make editable on dialog
 
+        # RoutePaintCache, or None if it needs to be recreated
+        self.paintCache = None
+
+    # must be called after anything affecting how the route looks (rating,
+    # marker, color, flipSide, position) has been changed
+    def changed(self):
+        self.paintCache = None
+
+    def getPaintCache(self):
+        if not self.paintCache:
+            self.paintCache = RoutePaintCache(self)
+
+        return self.paintCache
+
     # returns whether route existed at given date (util.Date)
     def existedAt(self, date):
         notBefore = not self.dateAdded or (date >= self.dateAdded)
@@ -1546,7 +3743,10 @@ class Route:
 
         return notBefore and notAfter
 
-    def attachTo(self, wall, t):
+    # attach route to given wall at given position. if recalc is False,
+    # the caller is responsible for calling recalcPos (or
+    # ClimbingWall.recalcRoutes) afterwards.
+    def attachTo(self, wall, t, recalc = True):
         if self.wall:
             self.wall.routes.remove(self)
 
@@ -1554,29 +3754,43 @@ class Route:
         self.wall.routes.append(self)
         self.t = t
 
-        self.recalcPos()
+        if CW:
+            CW.routeEdited(self)
 
-    def recalcPos(self):
-        AB = self.wall.p2 - self.wall.p1
+        if recalc:
+            self.recalcPos()
 
-        pos = self.wall.p1 + AB * self.t
+    def recalcPos(self):
+        p1 = self.wall.p1
+        p2 = self.wall.p2
 
-        self.x = pos.x
-        self.y = pos.y
+        abx = p2.x - p1.x
+        aby = p2.y - p1.y
 
-        AB.y = -AB.y
+        self.x = p1.x + abx * self.t
+        self.y = p1.y + aby * self.t
 
-        if AB.x != 0:
-            self.angle = math.atan(AB.y / AB.x) * 180.0 / math.pi
+        if abx != 0:
+            self.angle = math.atan(-aby / abx) * 180.0 / math.pi
         else:
             self.angle = 90.0
 
-        #print AB, self.angle
-
         if self.angle < 0:
             self.angle += 180
 
-        self.angle = 90 - self.angle
+        self.setPos(self.x, self.y, 90 - self.angle)
+
+    # set route's position and angle. only to be used by recalcPos and
+    # ClimbingWall.recalcRoutes.
+    def setPos(self, x, y, angle):
+        self.x = x
+        self.y = y
+        self.angle = angle
+
+        self.changed()
+
+        if CW:
+            CW.routeMoved(self)
 
     def toXml(self):
         el = etree.Element("Route")
@@ -1596,11 +3810,10 @@ class Route:
 
         return el
 
+    # wallsById: key = wall id, value = Wall
     @staticmethod
-    def load(el, cw):
-        r = Route()
-
-        r.id = util.getUUIDAttr(el, "id")
+    def load(el, wallsById):
+        r = Route(util.getUUIDAttr(el, "id"))
         r.color = Color.load(util.getAttr(el, "color"))
         r.marker = Marker.load(util.getAttr(el, "marker"))
         r.rating = Rating.load(util.getAttr(el, "rating"))
@@ -1608,50 +3821,118 @@ class Route:
         r.dateRemoved = util.getDateAttr(el, "dateRemoved")
 
         wallId = util.getUUIDAttr(el, "wallId")
-        wall = cw.walls.getWallById(wallId)
+        wall = wallsById.get(wallId)
 
         util.cfgAssert(wall, "Route attached to unknown wall '%s'" % wallId)
 
-        r.attachTo(wall, t = util.getFloatAttr(el, "t"))
+        # ClimbingWall.load calculates all route positions at once
+        r.attachTo(wall, util.getFloatAttr(el, "t"), False)
 
         return r
 
     def paint(self, pnt):
+        Route.paintList(pnt, [self])
+
+    # paint given list of routes. this is a lot faster than calling paint()
+    # for each of them separately, since the painter state only needs to
+    # be saved/restored once.
+    @staticmethod
+    def paintList(pnt, routes):
         pnt.save()
 
-        if mypd and 0:
-            # FIXME: remove
-            font = QtGui.QFont(self.font, mypd)
-            pnt.setFont(font)
-        else:
-            pnt.setFont(self.font)
+        # text is drawn using whatever pen the caller set up, but markers
+        # change the pen so it must be reset for each route
+        textPen = pnt.pen()
+        base = pnt.worldTransform()
 
-        pnt.translate(self.x, self.y)
-        pnt.rotate(self.angle)
+        pnt.setFont(gutil.getFont(*ROUTE_FONT)[0])
 
-        #pnt.scale(0.5, 0.5)
+        for route in routes:
+            pc = route.getPaintCache()
 
-        #pnt.drawLine(QLineF(0, 0, self.offset, 0))
+            pnt.setWorldTransform(pc.transform * base)
 
+            pnt.setPen(textPen)
+            pnt.drawText(pc.textPos, pc.text)
+
+            pnt.setPen(route.marker.pen)
+            pnt.setBrush(pc.brush)
+
+            for poly in pc.polygons:
+                pnt.drawPolygon(poly)
+
+        pnt.restore()
+
+    # paint given list of routes in a simplified form, without labels and
+    # with one draw call per color: as colored dots if dots is True,
+    # otherwise as colored squares.
+    @staticmethod
+    def paintSimple(pnt, routes, dots):
+        size = DOT_SIZE / M.viewportScale
+
+        # key = Color, value = list of routes
+        byColor = {}
+
+        for route in routes:
+            byColor.setdefault(route.color, []).append(route)
+
+        pnt.save()
+
+        # go through colors in a fixed order so partial repaints match
+        # full ones
+        for color in COLORS:
+            colorRoutes = byColor.get(color)
+
+            if not colorRoutes:
+                continue
+
+            if dots:
+                pen = QPen(color.brush.color())
+                pen.setWidthF(size)
+                pen.setCapStyle(QtCore.Qt.RoundCap)
+                pnt.setPen(pen)
+
+                pnt.drawPoints(QtGui.QPolygonF(
+                        [QPointF(r.x, r.y) for r in colorRoutes]))
+            else:
+                pnt.setPen(QtCore.Qt.NoPen)
+                pnt.setBrush(color.brush)
+
+                offset = size / 2.0
+
+                pnt.drawRects([QRectF(r.x - offset, r.y - offset, size, size)
+                               for r in colorRoutes])
+
+        pnt.restore()
+
+# precalculated data needed for painting a Route. these are created on
+# demand by Route.getPaintCache and thrown away by Route.changed.
+class RoutePaintCache:
+    def __init__(self, route):
         # FIXME: have an option whether to include name of color
-        #s = "%s %s" % (self.rating.text, self.color.name)
-        s = "%s" % (self.rating.text)
+        #s = "%s %s" % (route.rating.text, route.color.name)
+        self.text = "%s" % (route.rating.text)
 
-        textRect = pnt.boundingRect(0, 0, 0, 0, 0, s)
+        fontMetrics = gutil.getFont(*ROUTE_FONT)[1]
+        textSize = fontMetrics.size(0, self.text)
 
-        if self.flipSide:
-            x = -textRect.width() - self.offset * 1.5 - self.marker.size()
+        if route.flipSide:
+            x = -textSize.width() - route.offset * 1.5 - route.marker.size()
         else:
-            x = self.offset
+            x = route.offset
 
-        pnt.drawText(
-            QPointF(x, -self.fontMetrics.descent() + textRect.height() / 2.0),
-            s)
+        self.textPos = QPointF(
+            x, -fontMetrics.descent() + textSize.height() / 2.0)
 
-        x += textRect.width() + self.offset / 2.0
+        x += textSize.width() + route.offset / 2.0
 
-        self.marker.paint(pnt, self.color, x)
-        pnt.restore()
+        self.polygons = route.marker.getPolygons(x)
+        self.brush = route.color.brush
+
+        # route-local to logical coordinates
+        self.transform = QtGui.QTransform()
+        self.transform.translate(route.x, route.y)
+        self.transform.rotate(route.angle)
 
 
 # date widget that has an on/off selection as well that means "no date is
@@ -1783,21 +4064,150 @@ class MyWidget(QtGui.QWidget):
         self.setCursor(QtGui.QCursor(QtCore.Qt.BlankCursor))
         #self.setAttribute(QtCore.Qt.WA_OpaquePaintEvent)
 
+        # QRectFs, in logical coordinates, covering the mouse cursor and
+        # mode overlay as they were drawn by the last paint
+        self.overlayRects = []
+
+        # QRectFs, in logical coordinates, changed since the last call to
+        # updateOverlay, see addDirty
+        self.dirtyRects = []
+
+        # walls and routes only change on specific events, not on every
+        # mouse move like the cursor and mode overlay, so they're painted
+        # to this QPixmap which is then just copied to the screen on
+        # repaints. None if it needs to be painted from scratch.
+        self.staticCache = None
+
+        # (scale, width, height, drawEndPoints, showWallLengths) tuple
+        # that staticCache was painted with. if any of these change, it
+        # must be painted from scratch.
+        self.staticKey = None
+
+        # viewport offset (x, y) tuple that staticCache was painted with.
+        # if only this changes, the old contents are scrolled.
+        self.staticOffset = None
+
+        # parts of staticCache that need to be repainted, as QRectFs in
+        # logical coordinates and QRects in physical coordinates
+        self.staticDirtyRects = []
+        self.staticDirtyPhysRects = []
+
+    # mark given QRectF, in logical coordinates, as needing a repaint on
+    # the next updateOverlay call. this is for modes that change the walls
+    # or routes during mouse moves.
+    def addDirty(self, rect):
+        self.dirtyRects.append(rect)
+        self.staticDirtyRects.append(rect)
+
+    # throw away cached painting of walls and routes. must be called after
+    # anything affecting them changes, unless addDirty is used instead.
+    def invalidateStatic(self):
+        self.staticCache = None
+
+    # bring staticCache up to date
+    def updateStaticCache(self):
+        key = (M.viewportScale, self.width(), self.height(),
+               M.mode.drawEndPoints, M.showWallLengthsCb.isChecked())
+        offset = (M.viewportOffset.x, M.viewportOffset.y)
+
+        if self.staticCache and (key == self.staticKey) and \
+               (offset != self.staticOffset):
+            dx = (offset[0] - self.staticOffset[0]) * M.viewportScale
+            dy = (offset[1] - self.staticOffset[1]) * M.viewportScale
+
+            # can only scroll by whole pixels
+            if (abs(dx - round(dx)) < 0.01) and (abs(dy - round(dy)) < 0.01):
+                self.scrollStatic(int(round(dx)), int(round(dy)))
+            else:
+                self.staticCache = None
+
+        if not self.staticCache or (key != self.staticKey):
+            self.staticCache = QtGui.QPixmap(self.size())
+            self.staticDirtyRects = []
+            self.staticDirtyPhysRects = [self.rect()]
+
+        self.staticKey = key
+        self.staticOffset = offset
+
+        rects = self.staticDirtyPhysRects + [
+            M.log2physRect(r).adjusted(-2, -2, 2, 2)
+            for r in self.staticDirtyRects]
+
+        self.staticDirtyRects = []
+        self.staticDirtyPhysRects = []
+
+        if not rects:
+            return
+
+        pnt = QtGui.QPainter()
+        pnt.begin(self.staticCache)
+
+        bg = self.palette().color(QtGui.QPalette.Window)
+
+        for rect in rects:
+            pnt.save()
+            pnt.setClipRect(rect)
+            pnt.fillRect(rect, bg)
+
+            self.setupPainter(pnt)
+            self.paintStatic(pnt, M.phys2logRect(rect), getDetailLevel())
+
+            pnt.restore()
+
+        pnt.end()
+
+    # scroll staticCache contents by (dx, dy) pixels, marking the parts
+    # scrolled into view as needing a repaint
+    def scrollStatic(self, dx, dy):
+        pm = QtGui.QPixmap(self.size())
+
+        pnt = QtGui.QPainter()
+        pnt.begin(pm)
+        pnt.drawPixmap(dx, dy, self.staticCache)
+        pnt.end()
+
+        self.staticCache = pm
+
+        w = self.width()
+        h = self.height()
+
+        if dx > 0:
+            self.staticDirtyPhysRects.append(QtCore.QRect(0, 0, dx, h))
+        elif dx < 0:
+            self.staticDirtyPhysRects.append(QtCore.QRect(w + dx, 0, -dx, h))
+
+        if dy > 0:
+            self.staticDirtyPhysRects.append(QtCore.QRect(0, 0, w, dy))
+        elif dy < 0:
+            self.staticDirtyPhysRects.append(QtCore.QRect(0, h + dy, w, -dy))
+
+    # return QRectFs covering the mouse cursor and mode overlay
+    def getOverlayRects(self):
+        return circleRects(M.mousePos) + M.mode.overlayRects()
+
+    # like update(), but only schedules a repaint for the parts of the
+    # widget that may have changed: the cursor and mode overlay at their
+    # old and new positions, and anything marked with addDirty.
+    def updateOverlay(self):
+        for rect in (self.overlayRects + self.getOverlayRects() +
+                     self.dirtyRects):
+            self.update(M.log2physRect(rect).adjusted(-2, -2, 2, 2))
+
+        self.dirtyRects = []
+
     def keyPressEvent(self, event):
         key = event.key()
 
         if key == QtCore.Qt.Key_F:
             M.route.flipSide = not M.route.flipSide
+            M.route.changed()
             self.update()
         elif key == QtCore.Qt.Key_S:
-            global mypd
             #printer = QtGui.QPrinter(QtGui.QPrinter.HighResolution)
             printer = QtGui.QPrinter(QtGui.QPrinter.ScreenResolution)
             printer.setOutputFileName("wall.pdf")
             #printer.setResolution(1200)
 
-            mypd = printer
-
             pnt = QtGui.QPainter()
             pnt.begin(printer)
             self.paint(pnt)
@@ -1843,16 +4253,21 @@ class MyWidget(QtGui.QWidget):
         M.calcMousePos()
         M.mode.moveEvent()
 
-        self.update()
+        self.updateOverlay()
+
+    # mode button events can change walls and routes in many ways, so
+    # play it safe and repaint everything after them
 
     def mousePressEvent(self, event):
         M.mouseDown = True
         M.mode.buttonEvent(True)
+        self.invalidateStatic()
         self.update()
 
     def mouseReleaseEvent(self, event):
         M.mouseDown = False
         M.mode.buttonEvent(False)
+        self.invalidateStatic()
         self.update()
 
     def wheelEvent(self, event):
@@ -1868,16 +4283,27 @@ class MyWidget(QtGui.QWidget):
         self.update()
 
     def paintEvent(self, event):
+        self.updateStaticCache()
+
         pnt = QtGui.QPainter()
         pnt.begin(self)
 
-        self.paint(pnt)
+        pnt.drawPixmap(event.rect(), self.staticCache, event.rect())
+
+        self.overlayRects = self.getOverlayRects()
+        self.setupPainter(pnt)
+        self.paintOverlay(pnt)
 
         pnt.end()
 
+    # paint everything, without using any caches
     def paint(self, pnt):
-        #size = self.size()
+        self.setupPainter(pnt)
+        self.paintStatic(pnt)
+        self.paintOverlay(pnt)
 
+    # set up painter for painting in logical coordinates
+    def setupPainter(self, pnt):
         #print "scale: %f" % M.viewportScale
         pnt.scale(M.viewportScale, M.viewportScale)
 
@@ -1887,8 +4313,20 @@ class MyWidget(QtGui.QWidget):
         pnt.setRenderHint(QtGui.QPainter.Antialiasing)
         pnt.setRenderHint(QtGui.QPainter.TextAntialiasing)
 
-        CW.walls.paint(pnt, M.mode.drawEndPoints)
+    # paint walls and routes at given level of detail (DETAIL_*). if rect
+    # (QRectF, logical coordinates) is given, only things visible inside it
+    # need to be painted.
+    def paintStatic(self, pnt, rect = None, detail = DETAIL_FULL):
+        CW.walls.paint(pnt, M.mode.drawEndPoints, rect, detail)
+
+        pen = QPen(QtCore.Qt.blue)
+        pen.setWidthF(3.0 / M.viewportScale)
+        pnt.setPen(pen)
+
+        CW.paintRoutes(pnt, rect, detail)
 
+    # paint mouse cursor and mode overlay
+    def paintOverlay(self, pnt):
         pen = QPen(QtCore.Qt.red)
         pen.setWidthF(3.0 / M.viewportScale)
         pnt.setPen(pen)
@@ -1902,14 +4340,50 @@ class MyWidget(QtGui.QWidget):
         M.mode.paint(pnt)
 
 
+# add filter checkboxes, initially checked, in columns of 5 to hbox. items
+# is a list of (text, object) tuples, with the checkbox being stored in
+# each object's 'checkbox' attribute.
+def addFilterCheckboxes(hbox, parent, items):
+    vbox = None
+
+    for text, obj in items:
+        if not vbox:
+            vbox = QtGui.QVBoxLayout()
+            vbox.setAlignment(QtCore.Qt.AlignTop)
+            vbox.setSpacing(0)
+
+        cb = QtGui.QCheckBox(text, parent)
+        cb.setChecked(True)
+
+        # FIXME: attach a context menu to each checkbox with commands such as:
+        #  -select only this
+        #  -[un]select everything above/below
+
+        obj.checkbox = cb
+
+        QtCore.QObject.connect(
+            cb, QtCore.SIGNAL("stateChanged(int)"), M.updateRouteFilter)
+
+        vbox.addWidget(cb)
+
+        if vbox.count() == 5:
+            hbox.addLayout(vbox)
+            vbox = None
+
+    if vbox:
+        hbox.addLayout(vbox)
+
+
+# global Main and ClimbingWall instances, created in main()
+M = None
+CW = None
+
 def main():
-    global M, CW, mypd
+    global M, CW
 
     M = Main()
     CW = ClimbingWall()
 
-    mypd = None
-
     app = QtGui.QApplication(sys.argv)
 
     mw = QtGui.QMainWindow()
@@ -1959,41 +4433,34 @@ def main():
 
     vbox2.addWidget(M.showDeletedCb)
 
-    hbox.addLayout(vbox2)
-
-    vbox2 = None
+    M.historyCb = QtGui.QCheckBox("Show routes at:", w)
 
-    # FIXME: Add some label or surrounding frame for filter settings
-    for rating in Rating.RATINGS:
-        if rating.fractional:
-            continue
+    QtCore.QObject.connect(M.historyCb, QtCore.SIGNAL("stateChanged(int)"),
+                           M.historyToggled)
 
-        if not vbox2:
-            vbox2 = QtGui.QVBoxLayout()
-            vbox2.setAlignment(QtCore.Qt.AlignTop)
-            vbox2.setSpacing(0)
-            vbox.setContentsMargins(0, 0, 0, 0)
+    vbox2.addWidget(M.historyCb)
 
-        cb = QtGui.QCheckBox(rating.text, w)
-        cb.setChecked(True)
+    M.historySlider = QtGui.QSlider(QtCore.Qt.Horizontal, w)
+    M.historySlider.setEnabled(False)
 
-        # FIXME: attach a context menu to each checkbox with commands such as:
-        #  -select only this
-        #  -[un]select everything above/below
+    M.historyLabel = QtGui.QLabel(w)
 
-        rating.checkbox = cb
+    QtCore.QObject.connect(M.historySlider, QtCore.SIGNAL("valueChanged(int)"),
+                           M.historyMoved)
 
-        QtCore.QObject.connect(
-            cb, QtCore.SIGNAL("stateChanged(int)"), M.updateRouteFilter)
+    M.updateHistoryRange()
+    M.historySlider.setValue(M.historySlider.maximum())
 
-        vbox2.addWidget(cb)
+    vbox2.addWidget(M.historySlider)
+    vbox2.addWidget(M.historyLabel)
 
-        if vbox2.count() == 5:
-            hbox.addLayout(vbox2)
-            vbox2 = None
+    hbox.addLayout(vbox2)
 
-    if vbox2:
-        hbox.addLayout(vbox2)
+    # FIXME: Add some label or surrounding frame for filter settings
+    addFilterCheckboxes(hbox, w, [(r.text, r) for r in Rating.RATINGS
+                                  if not r.fractional])
+    addFilterCheckboxes(hbox, w, [(c.name, c) for c in COLORS])
+    addFilterCheckboxes(hbox, w, [(m.name, m) for m in Marker.MARKERS])
 
     M.includeFilter = Filter(True, hbox, w)
     M.excludeFilter = Filter(False, hbox, w)
@@ -2020,9 +4487,20 @@ def main():
 
     M.setMode(WallMoveMode, True)
 
+    autosaveTimer = QtCore.QTimer(mw)
+
+    QtCore.QObject.connect(autosaveTimer, QtCore.SIGNAL("timeout()"),
+                           M.autosave)
+
+    autosaveTimer.start(AUTOSAVE_INTERVAL * 1000)
+
     mw.show()
     M.w.setFocus()
 
     app.exec_()
 
-main()
+    M.autosave()
+    M.waitForSave()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,462 @@
+#!/usr/bin/python
+
+# command-line tool for working with climbing wall and climbing profile
+# files without the GUI, e.g. in batch jobs on machines with no display.
+# usage:
+#
+#  cwtool.py validate [-j N] file...
+#  cwtool.py convert infile outfile
+#  cwtool.py convert -t .ext [-j N] file...
+#  cwtool.py stats [-d YYYY-MM-DD] [-j N] file...
+#  cwtool.py merge outfile infile...
+#
+# whether a file is a climbing wall or a climbing profile, and whether it
+# is in XML or binary format, is detected from its contents. files written
+# out whose name ends in ".xml" are in XML format, all others in binary
+# format. the second form of convert writes each file next to itself with
+# the given extension.
+#
+# commands taking many files handle them in parallel in N worker
+# processes, by default one per CPU core. each worker only sends back a
+# short summary of each file.
+
+import cwall
+import error
+import util
+
+import itertools, multiprocessing, optparse, sys
+
+import lxml.etree as etree
+
+# return True if filename is for an XML format file
+def isXml(filename):
+    return filename.lower().endswith(cwall.XML_EXT)
+
+# set up what the cwall module needs for loading and saving files, which
+# is a Main object but no widgets. must be called once before anything
+# else.
+def init():
+    cwall.M = cwall.Main()
+
+# return ClimbingWall or ClimbingProfile loaded from given file. binary
+# format climbing walls are memory-mapped, so their routes are only
+# created when needed. if cls is given, the file must contain one of
+# those. throws EnvironmentError or error.ConfigError on errors.
+def loadFile(filename, cls = None):
+    f = open(filename, "rb")
+
+    try:
+        magic = f.read(len(cwall.ClimbingWall.BINARY_MAGIC))
+        f.seek(0)
+
+        if magic == cwall.ClimbingWall.BINARY_MAGIC:
+            fileCls = cwall.ClimbingWall
+        elif magic == cwall.ClimbingProfile.BINARY_MAGIC:
+            fileCls = cwall.ClimbingProfile
+        else:
+            magic = None
+            fileCls = getXmlClass(f)
+            f.seek(0)
+
+        util.cfgAssert((cls is None) or (fileCls == cls),
+                       "Not a %s file" % getDescription(cls))
+
+        if fileCls == cwall.ClimbingWall:
+            if magic:
+                return cwall.ClimbingWall.openSnapshot(filename)
+            else:
+                return cwall.ClimbingWall.load(f)
+
+        data = f.read()
+
+    finally:
+        f.close()
+
+    if magic:
+        return cwall.ClimbingProfile.loadBinary(data)
+    else:
+        return cwall.ClimbingProfile.load(data)
+
+# return ClimbingWall or ClimbingProfile depending on the root element of
+# XML file f
+def getXmlClass(f):
+    try:
+        for event, el in etree.iterparse(f, events = ("start",)):
+            if el.tag == "ClimbingWall":
+                return cwall.ClimbingWall
+            elif el.tag == "Profile":
+                return cwall.ClimbingProfile
+
+            break
+
+    except etree.XMLSyntaxError, e:
+        util.cfgAssert(0, "XML parsing error: %s" % e)
+
+    util.cfgAssert(0, "Not a climbing wall or climbing profile file")
+
+# return user-visible description of ClimbingWall or ClimbingProfile
+def getDescription(cls):
+    if cls == cwall.ClimbingWall:
+        return "climbing wall"
+    else:
+        return "climbing profile"
+
+# save ClimbingWall or ClimbingProfile to given file, atomically. throws
+# EnvironmentError on errors.
+def saveFile(obj, filename):
+    if isXml(filename):
+        data = cwall.toXmlData(obj.toXml())
+    else:
+        data = obj.toBinary()
+
+    util.writeFileAtomic(filename, data)
+
+# check everything in ClimbingWall or ClimbingProfile that is only checked
+# when it's first used, see ClimbingProfile.getWallProfile
+def checkAll(obj):
+    if isinstance(obj, cwall.ClimbingProfile):
+        obj.getWallProfiles()
+
+# return number of bits set in bitset
+def countBits(bits):
+    return bin(bits).count("1")
+
+# return statistics of ClimbingWall or ClimbingProfile as a list of
+# (description, value) tuples, value being either a number or a list of
+# (name, number) tuples. date (util.Date) is the date to count existing
+# routes at.
+def getStats(obj, date):
+    if isinstance(obj, cwall.ClimbingWall):
+        return getWallStats(obj, date)
+    else:
+        return getProfileStats(obj)
+
+def getWallStats(cw, date):
+    index = cw.attrIndex
+
+    length = sum([wall.p1.distanceTo(wall.p2) for wall in cw.walls.walls])
+
+    return [
+        ("Wall id", cw.id),
+        ("Wall segments", len(cw.walls.walls)),
+        ("Wall length (m)", "%.2f" % (length / cwall.SCALE)),
+        ("Routes", len(cw.routes)),
+        ("Routes per rating",
+         [(r.text, countBits(index.ratings.get(r, 0)))
+          for r in cwall.Rating.RATINGS if index.ratings.get(r)]),
+        ("Routes per color",
+         [(c.name, countBits(index.colors.get(c, 0)))
+          for c in cwall.COLORS if index.colors.get(c)]),
+        ("Routes per marker",
+         [(m.name, countBits(index.markers.get(m, 0)))
+          for m in cwall.Marker.MARKERS if index.markers.get(m)]),
+        ("Routes at %s" % date.save(),
+         countBits(index.existedAt(date.toOrdinal())))
+        ]
+
+def getProfileStats(cp):
+    cwProfs = cp.getWallProfiles()
+
+    # key = RouteProfile date attribute name, value = number of routes
+    # having it set
+    ascents = dict((name, 0) for name in cwall.RouteProfile.DATES)
+    routes = 0
+
+    for cwProf in cwProfs:
+        for rp in cwProf.routeProfiles.itervalues():
+            if not rp.shouldBeSaved():
+                continue
+
+            routes += 1
+
+            for name in cwall.RouteProfile.DATES:
+                if getattr(rp, name):
+                    ascents[name] += 1
+
+    return [
+        ("Name", cp.name),
+        ("Walls", len(cwProfs)),
+        ("Routes climbed", routes),
+        ("Ascents per type",
+         [(name, ascents[name]) for name in cwall.RouteProfile.DATES])
+        ]
+
+# print statistics returned by getStats
+def printStats(filename, stats):
+    print "%s:" % filename
+
+    for desc, value in stats:
+        if isinstance(value, list):
+            print "  %s:" % desc
+
+            for name, count in value:
+                print "    %-20s %d" % (name, count)
+        else:
+            print "  %-22s %s" % (desc + ":", value)
+
+# return objects (all ClimbingWalls or all ClimbingProfiles) merged into
+# one, which may be one of the objects. for climbing walls, which must
+# all be versions of the same wall, routes in later walls replace those
+# with the same id in earlier ones, and the wall geometry is that of the
+# last one. for climbing profiles, which should be of the same person,
+# the earliest date of each kind of ascent of each route is kept.
+def merge(objs):
+    cls = objs[0].__class__
+
+    for obj in objs[1:]:
+        util.cfgAssert(obj.__class__ == cls, "Can't merge climbing walls "
+                       "and climbing profiles together")
+
+    if cls == cwall.ClimbingWall:
+        return mergeWalls(objs)
+    else:
+        return mergeProfiles(objs)
+
+def mergeWalls(cws):
+    ret = cws[-1]
+    ret.createAllRoutes()
+
+    # Route.attachTo reports changes to the current wall
+    cwall.CW = ret
+
+    for cw in reversed(cws[:-1]):
+        util.cfgAssert(cw.id == ret.id,
+                       "Can't merge different climbing walls '%s' and '%s'" %
+                       (cw.id, ret.id))
+
+        cw.createAllRoutes()
+
+        for route in cw.routes:
+            if ret.getRouteSeq(route.id) is None:
+                ret.addRoute(cwall.Route.load(route.toXml(),
+                                              ret.walls.wallsById))
+
+    ret.recalcRoutes()
+
+    return ret
+
+def mergeProfiles(cps):
+    ret = cps[0]
+
+    for cp in cps[1:]:
+        for cwProf in cp.getWallProfiles():
+            for rp in cwProf.routeProfiles.itervalues():
+                if not rp.shouldBeSaved():
+                    continue
+
+                retRp = ret.getRouteProfile(cwProf.wallId, rp.routeId, True)
+
+                for name in cwall.RouteProfile.DATES:
+                    date = getattr(rp, name)
+                    retDate = getattr(retRp, name)
+
+                    if date and (not retDate or (date < retDate)):
+                        setattr(retRp, name, date)
+
+    return ret
+
+# return error message for exception thrown while handling files
+def getErrorMessage(e):
+    if isinstance(e, EnvironmentError) and e.strerror:
+        return e.strerror
+    else:
+        return str(e) or e.__class__.__name__
+
+# jobs done for each file by commands taking many files. they run in the
+# worker processes, so they take and return only small, picklable values.
+
+def validateJob(filename):
+    checkAll(loadFile(filename))
+
+# returns getStats result. util.Date can't be pickled, so the date is
+# given as an ordinal.
+def statsJob((filename, ordinal)):
+    return getStats(loadFile(filename), util.Date(ordinal))
+
+# returns name of file written
+def convertJob((filename, ext)):
+    outFile = cwall.getSidecarFilename(filename, ext)
+
+    util.cfgAssert(outFile != filename, "File already has extension '%s'" %
+                   ext)
+
+    saveFile(loadFile(filename), outFile)
+
+    return outFile
+
+# return (result, None) or (None, error message) tuple for calling job
+# with arg. anything going wrong is reported as a failure of that file,
+# so one bad file can't stop the others from being handled.
+def runJob((job, arg)):
+    try:
+        return (job(arg), None)
+
+    except Exception, e:
+        return (None, getErrorMessage(e))
+
+# call job with each of args, in opts.jobs worker processes, returning
+# iterator over the runJob results in the same order
+def runJobs(opts, job, args):
+    tasks = [(job, arg) for arg in args]
+
+    if opts.jobs == 1:
+        return itertools.imap(runJob, tasks)
+
+    pool = multiprocessing.Pool(opts.jobs, init)
+    results = pool.imap(runJob, tasks)
+
+    # no more tasks, so the workers exit once they're done
+    pool.close()
+
+    return results
+
+# call job with each of args as for runJobs and report the results, with
+# printResult being called with (filename, result) for successes. exits
+# with an error status after listing the files that failed, if any.
+def reportJobs(opts, job, filenames, args, printResult):
+    errors = []
+
+    for filename, (result, msg) in itertools.izip(
+        filenames, runJobs(opts, job, args)):
+        if msg is None:
+            printResult(filename, result)
+        else:
+            print "%s: %s" % (filename, msg)
+
+            errors.append((filename, msg))
+
+    if errors:
+        print >> sys.stderr, "%d of %d files failed:" % (
+            len(errors), len(filenames))
+
+        for filename, msg in errors:
+            print >> sys.stderr, "  %s: %s" % (filename, msg)
+
+        sys.exit(1)
+
+def cmdValidate(opts, args):
+    if not args:
+        return "no files given"
+
+    def printResult(filename, result):
+        print "%s: OK" % filename
+
+    reportJobs(opts, validateJob, args, args, printResult)
+
+def cmdConvert(opts, args):
+    if opts.to:
+        if not args:
+            return "no files given"
+
+        def printResult(filename, outFile):
+            print "%s: wrote %s" % (filename, outFile)
+
+        reportJobs(opts, convertJob, args,
+                   [(filename, opts.to) for filename in args], printResult)
+
+        return
+
+    if len(args) != 2:
+        return "wrong number of arguments"
+
+    inFile, outFile = args
+
+    try:
+        obj = loadFile(inFile)
+
+    except (EnvironmentError, error.ConfigError), e:
+        sys.exit("Error loading file '%s': %s" % (inFile, getErrorMessage(e)))
+
+    try:
+        saveFile(obj, outFile)
+
+    except EnvironmentError, e:
+        sys.exit("Error writing file '%s': %s" % (outFile, e.strerror))
+
+    except error.ConfigError, e:
+        sys.exit("Error loading file '%s': %s" % (inFile, e))
+
+def cmdStats(opts, args):
+    if not args:
+        return "no files given"
+
+    if opts.date:
+        try:
+            date = util.Date.load(opts.date)
+        except error.ConfigError, e:
+            return str(e)
+    else:
+        date = util.Date.now()
+
+    reportJobs(opts, statsJob, args,
+               [(filename, date.toOrdinal()) for filename in args],
+               printStats)
+
+def cmdMerge(opts, args):
+    if len(args) < 2:
+        return "wrong number of arguments"
+
+    outFile = args[0]
+    objs = []
+
+    for filename in args[1:]:
+        try:
+            objs.append(loadFile(filename))
+
+        except (EnvironmentError, error.ConfigError), e:
+            sys.exit("Error loading file '%s': %s" % (
+                    filename, getErrorMessage(e)))
+
+    try:
+        saveFile(merge(objs), outFile)
+
+    except EnvironmentError, e:
+        sys.exit("Error writing file '%s': %s" % (outFile, e.strerror))
+
+    except error.ConfigError, e:
+        sys.exit("Error merging files: %s" % e)
+
+# key = command name, value = function taking (options, arguments) and
+# returning an error message for bad arguments, or None
+COMMANDS = {
+    "validate" : cmdValidate,
+    "convert" : cmdConvert,
+    "stats" : cmdStats,
+    "merge" : cmdMerge,
+    }
+
+def main():
+    parser = optparse.OptionParser(
+        usage = "%prog validate [options] file...\n"
+        "       %prog convert infile outfile\n"
+        "       %prog convert -t .ext [options] file...\n"
+        "       %prog stats [options] file...\n"
+        "       %prog merge outfile infile...")
+    parser.add_option("-d", "--date", metavar = "YYYY-MM-DD",
+                      help = "date to count existing routes at in stats "
+                      "(default: today)")
+    parser.add_option("-t", "--to", metavar = ".ext",
+                      help = "convert files to ones with given extension "
+                      "next to them")
+    parser.add_option("-j", "--jobs", type = "int", metavar = "N",
+                      default = multiprocessing.cpu_count(),
+                      help = "number of worker processes (default: number "
+                      "of CPU cores)")
+
+    opts, args = parser.parse_args()
+
+    if not args or (args[0] not in COMMANDS):
+        parser.error("no command given")
+
+    if opts.jobs < 1:
+        parser.error("invalid number of jobs")
+
+    init()
+
+    msg = COMMANDS[args[0]](opts, args[1:])
+
+    if msg:
+        parser.error(msg)
+
+if __name__ == "__main__":
+    main()
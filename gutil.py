@@ -1,7 +1,27 @@
-from PyQt4 import QtCore
+from PyQt4 import QtGui, QtCore
 
 QRectF = QtCore.QRectF
 
+# key = (family, pixel size), value = (QFont, QFontMetrics)
+fontCache = {}
+
+# return (QFont, QFontMetrics) tuple for given font family and pixel size.
+# fonts are expensive to create and resolve, so they are created only once
+# per style and then shared by everyone (screen painting, PDF export, etc).
+def getFont(family, pixelSize):
+    key = (family, pixelSize)
+
+    ret = fontCache.get(key)
+
+    if not ret:
+        font = QtGui.QFont(family)
+        font.setPixelSize(pixelSize)
+
+        ret = (font, QtGui.QFontMetrics(font))
+        fontCache[key] = ret
+
+    return ret
+
 # draw centered ellipse
 def drawEllipse(pnt, center, size):
     offset = size / 2.0
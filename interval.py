@@ -0,0 +1,156 @@
+import bisect
+
+INF = float("inf")
+
+# index of half-open [start, end) intervals, answering "which items'
+# intervals contain point t" queries. items are non-negative integers, and
+# query results are bitsets: Python integers with bit N set if item N is
+# in the result. a start or end of None means the interval is unbounded in
+# that direction.
+#
+# the starts and ends of the intervals are kept in sorted lists. the
+# result of the last query is cached, and a query for a new point only
+# looks at the items having an endpoint between the old and the new point,
+# which makes moving the query point in small steps cheap.
+class EndpointIndex:
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        # sorted lists of (start, item) and (end, item) tuples, for those
+        # intervals that have a start / end
+        self.starts = []
+        self.ends = []
+
+        # key = item, value = (start, end)
+        self.intervals = {}
+
+        # (t, bitset) of the last query, or None
+        self.cache = None
+
+    def __len__(self):
+        return len(self.intervals)
+
+    # replace the contents of the index with given (item, start, end)
+    # tuples. this is the same as calling clear and then set for each of
+    # them, but a lot faster for large numbers of items.
+    def load(self, intervals):
+        self.clear()
+
+        for item, start, end in intervals:
+            self.intervals[item] = (start, end)
+
+            if start is not None:
+                self.starts.append((start, item))
+
+            if end is not None:
+                self.ends.append((end, item))
+
+        self.starts.sort()
+        self.ends.sort()
+
+    # set item's interval. if item is already in the index, its interval
+    # is replaced.
+    def set(self, item, start, end):
+        self.remove(item)
+
+        self.intervals[item] = (start, end)
+
+        if start is not None:
+            bisect.insort(self.starts, (start, item))
+
+        if end is not None:
+            bisect.insort(self.ends, (end, item))
+
+        self.updateCache(item)
+
+    # remove item from index. does nothing if item is not in the index.
+    def remove(self, item):
+        interval = self.intervals.pop(item, None)
+
+        if interval is None:
+            return
+
+        start, end = interval
+
+        if start is not None:
+            del self.starts[bisect.bisect_left(self.starts, (start, item))]
+
+        if end is not None:
+            del self.ends[bisect.bisect_left(self.ends, (end, item))]
+
+        self.updateCache(item)
+
+    # return the smallest endpoint of any interval, or None if there are
+    # none
+    def first(self):
+        points = [lst[0][0] for lst in (self.starts, self.ends) if lst]
+
+        if not points:
+            return None
+
+        return min(points)
+
+    # return True if item's interval contains t
+    def contains(self, item, t):
+        interval = self.intervals.get(item)
+
+        if interval is None:
+            return False
+
+        start, end = interval
+
+        return (((start is None) or (start <= t)) and
+                ((end is None) or (end > t)))
+
+    # return bitset of items whose interval contains t
+    def at(self, t):
+        if self.cache is None:
+            ret = 0
+
+            for item in self.intervals:
+                if self.contains(item, t):
+                    ret |= 1 << item
+
+            self.cache = (t, ret)
+
+            return ret
+
+        oldT, ret = self.cache
+
+        if t == oldT:
+            return ret
+
+        lo = min(t, oldT)
+        hi = max(t, oldT)
+
+        # an item can only be in one result but not the other if one of
+        # its endpoints is in (lo, hi]
+        for lst in (self.starts, self.ends):
+            # (x, INF) sorts after all (x, item) tuples
+            i1 = bisect.bisect_right(lst, (lo, INF))
+            i2 = bisect.bisect_right(lst, (hi, INF))
+
+            for endpoint, item in lst[i1:i2]:
+                if self.contains(item, t):
+                    ret |= 1 << item
+                else:
+                    ret &= ~(1 << item)
+
+        self.cache = (t, ret)
+
+        return ret
+
+    # bring item's bit in the cached result up to date
+    def updateCache(self, item):
+        if self.cache is None:
+            return
+
+        t, bits = self.cache
+
+        if self.contains(item, t):
+            bits |= 1 << item
+        else:
+            bits &= ~(1 << item)
+
+        self.cache = (t, bits)
@@ -0,0 +1,111 @@
+import util
+
+import os
+
+import lxml.etree as etree
+
+# append-only journal of changes made to a file since it was last saved in
+# full, so that saving changes often costs time proportional to the size
+# of the changes, not the size of the file. entries are XML elements,
+# stored one per line; what they mean is up to the user of the journal.
+#
+# when a full save is started, the journal is moved aside by rotate() and
+# a new one is started, and the old one is only deleted by discardOld()
+# once the full save has finished. this way a crash at any point leaves
+# the last full save plus every journaled change since then on disk.
+class Journal:
+    def __init__(self, filename):
+        self.filename = filename
+        self.oldFilename = filename + ".old"
+
+        # whether the changes being made should go in this journal, i.e.
+        # whether what's being edited has been loaded from or saved to the
+        # file this is the journal of. this is for the user of the journal
+        # to keep track of.
+        self.active = False
+
+    # append given elements, making sure they're on disk before returning.
+    # throws EnvironmentError on errors.
+    def append(self, elements):
+        if not elements:
+            return
+
+        # the leading newline makes sure that a partial entry left behind
+        # by a crash in the middle of an earlier append ends up on a line
+        # of its own
+        data = "\n" + "".join([etree.tostring(el) + "\n"
+                                for el in elements])
+
+        f = open(self.filename, "ab")
+
+        try:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+
+    # return list of all elements in the journal, oldest first. partial
+    # entries left behind by crashes in the middle of an append are
+    # ignored.
+    def read(self):
+        ret = []
+
+        for filename in (self.oldFilename, self.filename):
+            if not util.fileExists(filename):
+                continue
+
+            f = open(filename, "rb")
+
+            try:
+                lines = f.read().split("\n")
+            finally:
+                f.close()
+
+            for line in lines:
+                if not line:
+                    continue
+
+                try:
+                    ret.append(etree.fromstring(line))
+                except etree.XMLSyntaxError:
+                    pass
+
+        return ret
+
+    # move current entries aside before starting a full save. if the old
+    # entries from a previous full save that did not finish are still
+    # around, the current ones are added to them. throws EnvironmentError
+    # on errors.
+    def rotate(self):
+        if not util.fileExists(self.filename):
+            return
+
+        if not util.fileExists(self.oldFilename):
+            os.rename(self.filename, self.oldFilename)
+
+            return
+
+        f = open(self.filename, "rb")
+
+        try:
+            data = f.read()
+        finally:
+            f.close()
+
+        f = open(self.oldFilename, "ab")
+
+        try:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+
+        os.remove(self.filename)
+
+    # delete the entries moved aside by rotate(), once the full save they
+    # were moved aside for has finished. throws EnvironmentError on errors.
+    def discardOld(self):
+        if util.fileExists(self.oldFilename):
+            os.remove(self.oldFilename)
@@ -0,0 +1,282 @@
+import math
+
+# uniform grid spatial index. items are stored in every grid cell they
+# touch, which makes "what is the closest item to this point" queries only
+# need to look at the cells near the point instead of scanning through
+# every item.
+class Grid:
+    def __init__(self, cellSize):
+        # width/height of a single grid cell, in logical coordinates
+        self.cellSize = float(cellSize)
+
+        self.clear()
+
+    def clear(self):
+        # key = (x, y) cell coordinates, value = set of items in that cell
+        self.cells = {}
+
+        # key = item, value = list of cell coordinates the item is in
+        self.items = {}
+
+        # bounds of all cells ever used, in cell coordinates. these only
+        # ever grow (until clear() is called), which is fine since they're
+        # only used to limit how far closest() searches.
+        self.minX = None
+        self.minY = None
+        self.maxX = None
+        self.maxY = None
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, item):
+        return item in self.items
+
+    # return cell coordinate for given logical coordinate
+    def cell(self, val):
+        return int(math.floor(val / self.cellSize))
+
+    # add item whose bounding box is (x1, y1) - (x2, y2). for items that
+    # are just a point, x2/y2 can be left out. if item is already in the
+    # grid, it is moved to its new location.
+    def add(self, item, x1, y1, x2 = None, y2 = None):
+        if item in self.items:
+            self.remove(item)
+
+        if x2 is None:
+            x2 = x1
+            y2 = y1
+
+        cx1 = self.cell(min(x1, x2))
+        cx2 = self.cell(max(x1, x2))
+        cy1 = self.cell(min(y1, y2))
+        cy2 = self.cell(max(y1, y2))
+
+        keys = []
+
+        for cx in xrange(cx1, cx2 + 1):
+            for cy in xrange(cy1, cy2 + 1):
+                keys.append((cx, cy))
+
+        self.addToCells(item, keys, cx1, cy1, cx2, cy2)
+
+    # add point items, given as (item, x, y) tuples, none of which may
+    # already be in the grid. this is the same as calling add for each of
+    # them, but a lot faster for large numbers of items.
+    def addPoints(self, points):
+        cellSize = self.cellSize
+        floor = math.floor
+        cells = self.cells
+        items = self.items
+
+        cxs = []
+        cys = []
+
+        for item, x, y in points:
+            key = (int(floor(x / cellSize)), int(floor(y / cellSize)))
+
+            cell = cells.get(key)
+
+            if cell is None:
+                cell = set()
+                cells[key] = cell
+
+            cell.add(item)
+            items[item] = [key]
+
+            cxs.append(key[0])
+            cys.append(key[1])
+
+        if not cxs:
+            return
+
+        if self.minX is None:
+            self.minX, self.maxX = min(cxs), max(cxs)
+            self.minY, self.maxY = min(cys), max(cys)
+        else:
+            self.minX = min(self.minX, min(cxs))
+            self.maxX = max(self.maxX, max(cxs))
+            self.minY = min(self.minY, min(cys))
+            self.maxY = max(self.maxY, max(cys))
+
+    # add line segment (x1, y1) - (x2, y2). unlike add(), this only puts
+    # the item in the cells the segment actually passes through, which
+    # matters for long diagonal segments. if item is already in the grid,
+    # it is moved to its new location.
+    def addSegment(self, item, x1, y1, x2, y2):
+        if item in self.items:
+            self.remove(item)
+
+        if x1 > x2:
+            x1, y1, x2, y2 = x2, y2, x1, y1
+
+        cx1 = self.cell(x1)
+        cx2 = self.cell(x2)
+
+        keys = []
+
+        # go through the segment one column at a time, adding the cells
+        # covered by the part of the segment within that column
+        for cx in xrange(cx1, cx2 + 1):
+            if cx1 == cx2:
+                ya, yb = y1, y2
+            else:
+                xa = max(x1, cx * self.cellSize)
+                xb = min(x2, (cx + 1) * self.cellSize)
+
+                ya = y1 + (y2 - y1) * (xa - x1) / (x2 - x1)
+                yb = y1 + (y2 - y1) * (xb - x1) / (x2 - x1)
+
+            for cy in xrange(self.cell(min(ya, yb)),
+                             self.cell(max(ya, yb)) + 1):
+                keys.append((cx, cy))
+
+        self.addToCells(item, keys, cx1, self.cell(min(y1, y2)),
+                        cx2, self.cell(max(y1, y2)))
+
+    # add item to given cells. (cx1, cy1) - (cx2, cy2) is the bounding
+    # box of the cells, in cell coordinates.
+    def addToCells(self, item, keys, cx1, cy1, cx2, cy2):
+        for key in keys:
+            cell = self.cells.get(key)
+
+            if cell is None:
+                cell = set()
+                self.cells[key] = cell
+
+            cell.add(item)
+
+        self.items[item] = keys
+
+        if self.minX is None:
+            self.minX, self.maxX = cx1, cx2
+            self.minY, self.maxY = cy1, cy2
+        else:
+            self.minX = min(self.minX, cx1)
+            self.maxX = max(self.maxX, cx2)
+            self.minY = min(self.minY, cy1)
+            self.maxY = max(self.maxY, cy2)
+
+    # like add, but does nothing if item is not already in the grid
+    def update(self, item, x1, y1, x2 = None, y2 = None):
+        if item in self.items:
+            self.add(item, x1, y1, x2, y2)
+
+    # remove item from grid. does nothing if item is not in the grid.
+    def remove(self, item):
+        keys = self.items.pop(item, None)
+
+        if keys is None:
+            return
+
+        for key in keys:
+            cell = self.cells[key]
+            cell.discard(item)
+
+            if not cell:
+                del self.cells[key]
+
+    # return set of items in the cells overlapping the rectangle (x1, y1) -
+    # (x2, y2). this may include items near the rectangle that are not
+    # actually inside it.
+    def query(self, x1, y1, x2, y2):
+        if not self.items:
+            return set()
+
+        cx1 = max(self.cell(x1), self.minX)
+        cx2 = min(self.cell(x2), self.maxX)
+        cy1 = max(self.cell(y1), self.minY)
+        cy2 = min(self.cell(y2), self.maxY)
+
+        # no need to go through the cells if everything is included
+        if ((cx1 == self.minX) and (cx2 == self.maxX) and
+            (cy1 == self.minY) and (cy2 == self.maxY)):
+            return set(self.items)
+
+        ret = set()
+
+        for cx in xrange(cx1, cx2 + 1):
+            for cy in xrange(cy1, cy2 + 1):
+                cell = self.cells.get((cx, cy))
+
+                if cell:
+                    ret.update(cell)
+
+        return ret
+
+    # return (item, distance) tuple of the item closest to (x, y), or
+    # (None, None) if the grid is empty. distFunc is called with an item
+    # as its only argument and must return the item's distance to (x, y);
+    # it is only called for items near (x, y).
+    def closest(self, x, y, distFunc):
+        if not self.items:
+            return (None, None)
+
+        cx = self.cell(x)
+        cy = self.cell(y)
+
+        # the furthest we might need to search to cover all cells
+        maxRing = max(cx - self.minX, self.maxX - cx,
+                      cy - self.minY, self.maxY - cy)
+
+        closestItem = None
+        closestDistance = None
+        seen = set()
+
+        ring = 0
+
+        while ring <= maxRing:
+            for key in self.ring(cx, cy, ring):
+                cell = self.cells.get(key)
+
+                if not cell:
+                    continue
+
+                for item in cell:
+                    if item in seen:
+                        continue
+
+                    seen.add(item)
+
+                    dst = distFunc(item)
+
+                    if (closestDistance is None) or (dst < closestDistance):
+                        closestDistance = dst
+                        closestItem = item
+
+            # (x, y) is inside the center cell, so any item not yet seen
+            # lies completely outside the rings searched so far and thus
+            # is at least this far away
+            if ((closestDistance is not None) and
+                (closestDistance <= ring * self.cellSize)):
+                break
+
+            ring += 1
+
+        return (closestItem, closestDistance)
+
+    # generate cell coordinates of the square ring that is 'ring' cells
+    # away from (cx, cy), skipping cells outside the grid's bounds
+    def ring(self, cx, cy, ring):
+        if ring == 0:
+            yield (cx, cy)
+
+            return
+
+        x1 = max(cx - ring, self.minX)
+        x2 = min(cx + ring, self.maxX)
+
+        # top and bottom rows
+        for y in (cy - ring, cy + ring):
+            if self.minY <= y <= self.maxY:
+                for x in xrange(x1, x2 + 1):
+                    yield (x, y)
+
+        y1 = max(cy - ring + 1, self.minY)
+        y2 = min(cy + ring - 1, self.maxY)
+
+        # left and right columns, excluding the corners
+        for x in (cx - ring, cx + ring):
+            if self.minX <= x <= self.maxX:
+                for y in xrange(y1, y2 + 1):
+                    yield (x, y)
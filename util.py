@@ -1,7 +1,7 @@
 import error
 
+import datetime
 import os
-import re
 import time
 import uuid
 
@@ -33,95 +33,114 @@ class TimerDev:
         print "%s%s took %.5f seconds" % (" " * self.__class__.nestingLevel,
                                           self.msg, self.t)
 
-# simple Date class
-class Date:
-    def __init__(self):
-        self.year = 0
-        self.month = 0
-        self.day = 0
+# simple immutable Date class, stored as a day ordinal (see
+# datetime.date.toordinal)
+class Date(object):
+    __slots__ = ("ordinal",)
 
+    # cached result of now(), and the time.time() value when it stops
+    # being valid (next midnight)
+    today = None
+    todayExpires = 0
+
+    # key = string, value = Date, for load()
+    loadCache = {}
+
+    def __init__(self, ordinal):
+        self.ordinal = ordinal
+
+    # return current date
     @staticmethod
     def now():
-        return Date.fromQDate(QtCore.QDate.currentDate())
+        t = time.time()
 
-    def __lt__(self, rhs):
-        if self.year < rhs.year:
-            return True
-        elif self.year > rhs.year:
-            return False
+        if t >= Date.todayExpires:
+            today = datetime.date.today()
+            tomorrow = today + datetime.timedelta(1)
 
-        # same year
+            Date.today = Date(today.toordinal())
+            Date.todayExpires = time.mktime(tomorrow.timetuple())
 
-        if self.month < rhs.month:
-            return True
-        elif self.month > rhs.month:
-            return False
+        return Date.today
 
-        # same month
+    @staticmethod
+    def fromYMD(year, month, day):
+        return Date(datetime.date(year, month, day).toordinal())
 
-        if self.day < rhs.day:
-            return True
-        elif self.day > rhs.day:
-            return False
+    @staticmethod
+    def fromOrdinal(ordinal):
+        return Date(ordinal)
 
-        # same day
+    # return Date for a day ordinal read from a file, throwing
+    # error.ConfigError if it's outside the range datetime can handle, so
+    # bad dates are caught when loading and not when saving
+    @staticmethod
+    def loadOrdinal(ordinal):
+        cfgAssert(0 < ordinal <= datetime.date.max.toordinal(),
+                  "Invalid date")
 
-        return False
+        return Date(ordinal)
 
-    def __ge__(self, rhs):
-        if self.year > rhs.year:
-            return True
-        elif self.year < rhs.year:
-            return False
+    def toOrdinal(self):
+        return self.ordinal
+
+    def toDate(self):
+        return datetime.date.fromordinal(self.ordinal)
 
-        # same year
+    def __eq__(self, rhs):
+        return isinstance(rhs, Date) and (self.ordinal == rhs.ordinal)
 
-        if self.month > rhs.month:
-            return True
-        elif self.month < rhs.month:
-            return False
+    def __ne__(self, rhs):
+        return not self.__eq__(rhs)
 
-        # same month
+    def __lt__(self, rhs):
+        return self.ordinal < rhs.ordinal
 
-        if self.day > rhs.day:
-            return True
-        elif self.day < rhs.day:
-            return False
+    def __le__(self, rhs):
+        return self.ordinal <= rhs.ordinal
 
-        # same day
+    def __gt__(self, rhs):
+        return self.ordinal > rhs.ordinal
 
-        return True
+    def __ge__(self, rhs):
+        return self.ordinal >= rhs.ordinal
+
+    def __hash__(self):
+        return self.ordinal
 
     def save(self):
-        return "%04d-%02d-%02d" % (self.year, self.month, self.day)
+        return self.toDate().isoformat()
 
+    # parse date in YYYY-MM-DD format. since Dates are immutable, the same
+    # object is returned for all identical strings.
     @staticmethod
     def load(s):
-        d = Date()
+        d = Date.loadCache.get(s)
+
+        if d:
+            return d
 
-        m = re.match(r"^(\d{4})-(\d{2})-(\d{2})$", s)
+        try:
+            if ((len(s) != 10) or (s[4] != "-") or (s[7] != "-") or
+                not (s[:4] + s[5:7] + s[8:]).isdigit()):
+                raise ValueError()
 
-        if not m:
+            d = Date.fromYMD(int(s[:4]), int(s[5:7]), int(s[8:]))
+        except ValueError:
             cfgAssert(0, "Invalid Date attribute '%s'" % s)
 
-        d.year = int(m.group(1))
-        d.month = int(m.group(2))
-        d.day = int(m.group(3))
+        Date.loadCache[s] = d
 
         return d
 
     def toQDate(self):
-        return QtCore.QDate(self.year, self.month, self.day)
+        dt = self.toDate()
+
+        return QtCore.QDate(dt.year, dt.month, dt.day)
 
     @staticmethod
     def fromQDate(qd):
-        d = Date()
-
-        d.year = qd.year()
-        d.month = qd.month()
-        d.day = qd.day()
-
-        return d
+        return Date.fromYMD(qd.year(), qd.month(), qd.day())
 
 # save Date object if it's not None
 def saveDate(date, name, el):
@@ -150,26 +169,111 @@ def loadFile(filename, parent, maxSize = -1):
 
     return ret
 
+# open 'filename' for reading, returning the file object or None on
+# errors. pops up message boxes using 'parent' as parent on errors.
+def openFile(filename, parent):
+    try:
+        return open(filename, "rb")
+
+    except IOError, (errno, strerror):
+        QtGui.QMessageBox.critical(
+            parent, "Error", "Error loading file '%s': %s" % (
+                filename, strerror))
+
+        return None
+
 # write 'data' to 'filename', popping up a messagebox using 'parent'
 # (QWidget) as parent on errors. returns True on success.
 def writeToFile(filename, data, parent):
     try:
-        f = open(filename, "wb")
-
-        try:
-            f.write(data)
-        finally:
-            f.close()
+        writeFileAtomic(filename, data)
 
         return True
 
-    except IOError, (errno, strerror):
+    except EnvironmentError, (errno, strerror):
         QtGui.QMessageBox.critical(
             parent, "Error", "Error writing file '%s': %s" % (
                 filename, strerror))
 
         return False
 
+# write 'data' to 'filename' so that it either has the old or the new
+# contents even if we crash halfway: the data is written to a temporary
+# file, flushed to disk, and the temporary file is then renamed over the
+# old one, after which the directory is flushed too so the rename itself
+# is on disk. anyone still reading (or having memory-mapped) the old file
+# keeps seeing the old contents. the temporary file is removed on errors.
+# throws EnvironmentError on errors.
+def writeFileAtomic(filename, data):
+    tmpFilename = filename + ".tmp"
+
+    f = open(tmpFilename, "wb")
+    ok = False
+
+    try:
+        try:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+
+        os.rename(tmpFilename, filename)
+        ok = True
+
+    finally:
+        if not ok:
+            try:
+                os.remove(tmpFilename)
+            except OSError:
+                pass
+
+    fsyncDir(os.path.dirname(filename) or ".")
+
+# flush directory entry changes (new, removed or renamed files) in given
+# directory to disk. throws EnvironmentError on errors.
+def fsyncDir(dirname):
+    fd = os.open(dirname, os.O_RDONLY)
+
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+# thread that writes files in the background, so the GUI does not freeze
+# while large files are serialized and written out. 'work' is a list of
+# (filename, func) tuples, func returning the data to write to filename.
+# the funcs are called in the thread, so they must not touch anything the
+# GUI thread may modify meanwhile; typically they serialize an lxml tree
+# created just for this save. the files are written in order, each one
+# using writeFileAtomic, stopping at the first error of any kind.
+class SaveThread(QtCore.QThread):
+    def __init__(self, work, parent):
+        QtCore.QThread.__init__(self, parent)
+
+        self.work = work
+
+        # (filename, error message) of the write that failed, or None
+        self.error = None
+
+    def run(self):
+        for filename, func in self.work:
+            try:
+                writeFileAtomic(filename, func())
+
+            except EnvironmentError, (errno, strerror):
+                self.error = (filename, strerror)
+
+                return
+
+            # anything else going wrong (e.g. running out of memory while
+            # serializing) must also be reported as a failed save, or the
+            # caller would think the file has been replaced
+            except Exception, e:
+                self.error = (filename, str(e) or e.__class__.__name__)
+
+                return
+
 # return a string representation of a floating point value that preserves
 # all precision, i.e. "val = float(float2str(val))" is guaranteed to be a
 # no-op